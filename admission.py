@@ -0,0 +1,122 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from tracing import span
+
+
+class Overloaded(Exception):
+    """A workload class's queue is full; the request is shed instead of queued."""
+
+
+class _Waiter:
+    __slots__ = ("event", "admitted")
+
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.admitted = False
+
+
+class _WorkloadClass:
+    def __init__(self, concurrency, queue):
+        self.concurrency = concurrency
+        self.max_queue = queue
+        self.running = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.wait_seconds = 0.0
+
+
+class AdmissionController:
+    """
+    Limits how many model requests of each workload class run at once.
+
+    Every class ("text", "image", "voice", "file", "image_generation") has its
+    own concurrency limit and a bounded FIFO queue, so a wave of slow image
+    generations waits for its own slots instead of taking key quota and event
+    loop time from fast text chats. A request that finds its class's queue full
+    is shed with Overloaded. While a request waits, on_position(position) is
+    called whenever its place in the queue changes, e.g. to update a status
+    message.
+    """
+
+    def __init__(self, limits):
+        self.classes = {name: _WorkloadClass(**limit) for name, limit in limits.items()}
+
+    @asynccontextmanager
+    async def slot(self, workload, on_position=None):
+        """Holds a slot of `workload` for the duration of the block."""
+        await self._acquire(self.classes[workload], on_position)
+        try:
+            yield
+        finally:
+            self._release(self.classes[workload])
+
+    async def _acquire(self, cls, on_position):
+        if cls.running < cls.concurrency and not cls.waiters:
+            cls.running += 1
+            cls.admitted += 1
+            return
+        if len(cls.waiters) >= cls.max_queue:
+            cls.shed += 1
+            raise Overloaded("Too many requests are waiting; try again in a few minutes.")
+        waiter = _Waiter()
+        cls.waiters.append(waiter)
+        cls.queued += 1
+        started = time.monotonic()
+        position = None
+        try:
+            with span("admission_wait"):
+                while not waiter.admitted:
+                    current = cls.waiters.index(waiter) + 1
+                    if on_position and current != position:
+                        on_position(current)
+                    position = current
+                    waiter.event.clear()
+                    await waiter.event.wait()
+        except BaseException:
+            if waiter.admitted:
+                self._release(cls)
+            else:
+                cls.waiters.remove(waiter)
+                self._notify(cls)
+            raise
+        cls.admitted += 1
+        cls.wait_seconds += time.monotonic() - started
+
+    def _release(self, cls):
+        cls.running -= 1
+        if cls.waiters and cls.running < cls.concurrency:
+            # نوبت مستقیم به نفر اول صف داده می‌شود
+            waiter = cls.waiters.popleft()
+            waiter.admitted = True
+            cls.running += 1
+            waiter.event.set()
+        self._notify(cls)
+
+    @staticmethod
+    def _notify(cls):
+        for waiter in cls.waiters:
+            waiter.event.set()
+
+    def capacity(self):
+        """How many requests all classes together can run or queue; any more are shed."""
+        return sum(cls.concurrency + cls.max_queue for cls in self.classes.values())
+
+    def stats(self):
+        return {
+            name: {
+                "running": cls.running,
+                "concurrency": cls.concurrency,
+                "waiting": len(cls.waiters),
+                "max_queue": cls.max_queue,
+                "admitted": cls.admitted,
+                "queued": cls.queued,
+                "shed": cls.shed,
+                "avg_wait_ms": round(cls.wait_seconds / cls.queued * 1000, 1) if cls.queued else 0.0,
+            }
+            for name, cls in self.classes.items()
+        }
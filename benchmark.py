@@ -0,0 +1,447 @@
+"""
+Offline load benchmark of the bot's handlers.
+
+The real handlers, registered exactly as main.py registers them, run on a real
+AsyncTeleBot against an in-process fake Telegram Bot API and a fake streaming
+Gemini client, so no token, network or quota is needed. For every scenario
+(text, group, photo, document, draw) and concurrency level it reports
+throughput, end-to-end latency percentiles, message edits per response, peak
+RSS and event-loop lag.
+
+    python benchmark.py
+    python benchmark.py --scenarios text,photo --concurrency 1,16,64 --json before.json
+
+Run it before and after a change with the same arguments and compare.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from PIL import Image
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+
+try:
+    import resource
+except ImportError:  # ویندوز
+    resource = None
+
+
+SCENARIOS = ("text", "group", "photo", "document", "draw")
+PROMPT_FILES = ("default_prompt.txt", "default_image_processing_prompt.txt")
+TEXT_PROMPT = "یک توضیح کوتاه درباره سیاه‌چاله‌ها بده."
+ANSWER_TEXT = (
+    "سیاه‌چاله ناحیه‌ای از فضا است که **گرانش** آن آن‌قدر زیاد است که حتی نور هم نمی‌تواند از آن فرار کند. "
+    "مرز آن را `event horizon` می‌نامند.\n\n* جرم زیاد\n* چگالی بسیار بالا\n* تابش هاوکینگ\n\n"
+)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of `values`; 0.0 when there are none."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, or None where the platform does not report it."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _text_of(contents):
+    if isinstance(contents, str):
+        return contents
+    texts = []
+    for item in contents if isinstance(contents, (list, tuple)) else (contents,):
+        if isinstance(item, str):
+            texts.append(item)
+        elif isinstance(item, dict):
+            texts.extend(part.get("text", "") for part in item.get("parts", [item]) if isinstance(part, dict))
+    return "\n".join(text for text in texts if text)
+
+
+class FakeTelegram:
+    """
+    The Bot API calls the handlers make, answered in-process after `latency` seconds.
+    It takes the place of the aiohttp helpers every AsyncTeleBot request and download goes through.
+    """
+
+    def __init__(self, latency, error_texts, overloaded_texts):
+        self.latency = latency
+        self.error_texts = error_texts
+        self.overloaded_texts = overloaded_texts
+        self.files = {}  # file kind -> bytes
+        self.calls = Counter()
+        self.errors = 0
+        self.shed = 0
+        self._ids = itertools.count(1)
+
+    def install(self):
+        asyncio_helper._process_request = self.process_request
+        asyncio_helper.download_file = self.download_file
+
+    def _message(self, chat_id, text):
+        chat_id = int(chat_id)
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": text,
+        }
+
+    async def process_request(self, token, url, method="get", params=None, files=None, **kwargs):
+        self.calls[url] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = params or {}
+        text = str(params.get("text") or params.get("caption") or "")
+        if any(error in text for error in self.error_texts):
+            self.errors += 1
+        elif any(overloaded in text for overloaded in self.overloaded_texts):
+            self.shed += 1
+        if url == "sendMessage":
+            return self._message(params["chat_id"], text)
+        if url == "sendPhoto":
+            message = self._message(params["chat_id"], "")
+            message["photo"] = [{"file_id": f"sent-{message['message_id']}", "file_unique_id": f"sent-{message['message_id']}",
+                                 "width": 512, "height": 512}]
+            return message
+        if url == "editMessageText":
+            message = self._message(params.get("chat_id", 1), text)
+            message["message_id"] = int(params.get("message_id", 0))
+            return message
+        if url == "getChatMember":
+            return {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "Bench"}}
+        if url == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_path": file_id,
+                    "file_size": len(self.files[file_id.split("-")[0]])}
+        return True
+
+    async def download_file(self, token, file_path):
+        self.calls["download"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.files[file_path.split("-")[0]]
+
+
+class FakeGemini:
+    """
+    Stands in for google-genai's Client. Streamed answers wait `first_chunk_seconds` for the
+    first chunk, then send `chunks` chunks of `chunk_chars` characters `chunk_seconds` apart;
+    image generation answers with `image` after `image_seconds`.
+    """
+
+    def __init__(self, first_chunk_seconds, chunk_seconds, chunks, chunk_chars, image_seconds, image):
+        self.first_chunk_seconds = first_chunk_seconds
+        self.chunk_seconds = chunk_seconds
+        self.image_seconds = image_seconds
+        self.image = image
+        answer = ANSWER_TEXT * (chunks * chunk_chars // len(ANSWER_TEXT) + 1)
+        self.chunks = [answer[i * chunk_chars:(i + 1) * chunk_chars] for i in range(chunks)]
+        self.calls = Counter()
+
+    def Client(self, api_key):
+        backend = self
+
+        class Chats:
+            def create(self, model, history=None, config=None):
+                return _FakeChat(backend, history)
+
+        class Models:
+            async def get(self, model):
+                return None
+
+            async def generate_content(self, model, contents, config=None):
+                backend.calls["generate_content"] += 1
+                await asyncio.sleep(backend.first_chunk_seconds)
+                return SimpleNamespace(text="".join(backend.chunks), candidates=[])
+
+            async def generate_content_stream(self, model, contents, config=None):
+                backend.calls["generate_content_stream"] += 1
+                return backend.stream()
+
+        class Caches:
+            async def create(self, model, config):
+                backend.calls["caches.create"] += 1
+                return SimpleNamespace(name=f"cachedContents/{api_key}-{model}", expire_time=None)
+
+            async def update(self, name, config):
+                return SimpleNamespace(name=name, expire_time=None)
+
+        return SimpleNamespace(aio=SimpleNamespace(chats=Chats(), models=Models(), caches=Caches()))
+
+    async def stream(self, answer=None):
+        await asyncio.sleep(self.first_chunk_seconds)
+        for i, text in enumerate(self.chunks):
+            if i:
+                await asyncio.sleep(self.chunk_seconds)
+            if answer is not None:
+                answer.append(text)
+            yield SimpleNamespace(text=text)
+
+    def image_response(self):
+        part = SimpleNamespace(text=None, inline_data=SimpleNamespace(mime_type="image/png", data=self.image))
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+class _FakeChat:
+    def __init__(self, backend, history):
+        self.backend = backend
+        self.history = list(history or [])
+
+    def get_history(self):
+        return list(self.history)
+
+    async def send_message_stream(self, message):
+        self.backend.calls["send_message_stream"] += 1
+        self.history.append({"role": "user", "parts": [{"text": _text_of(message)}]})
+        answer = []
+
+        async def chunks():
+            async for chunk in self.backend.stream(answer):
+                yield chunk
+            self.history.append({"role": "model", "parts": [{"text": "".join(answer)}]})
+        return chunks()
+
+    async def send_message(self, message):
+        self.backend.calls["send_message"] += 1
+        await asyncio.sleep(self.backend.image_seconds)
+        return self.backend.image_response()
+
+
+class LoopLag:
+    """Samples how late the event loop wakes up a task that sleeps `interval` seconds."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.monotonic() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+def _jpeg(side):
+    buffer = io.BytesIO()
+    Image.effect_noise((side, side * 3 // 4), 48).convert("RGB").save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _png(side):
+    buffer = io.BytesIO()
+    Image.linear_gradient("L").resize((side, side)).convert("RGB").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def build_update(n, scenario, user_id, telegram):
+    """A Telegram update of `scenario` from `user_id`; every photo and document has its own file id."""
+    chat_id = -user_id if scenario == "group" else user_id
+    message = {
+        "message_id": n,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+    }
+    if scenario == "text":
+        message["text"] = TEXT_PROMPT
+    elif scenario == "group":
+        message["text"] = "." + TEXT_PROMPT
+    elif scenario == "photo":
+        message["photo"] = [{"file_id": f"photo-{n}", "file_unique_id": f"photo-{n}", "width": 1280, "height": 960,
+                             "file_size": len(telegram.files["photo"])}]
+        message["caption"] = "این عکس را توصیف کن."
+    elif scenario == "document":
+        message["document"] = {"file_id": f"document-{n}", "file_unique_id": f"document-{n}", "file_name": "notes.txt",
+                               "mime_type": "text/plain", "file_size": len(telegram.files["document"])}
+        message["caption"] = "این فایل را خلاصه کن."
+    elif scenario == "draw":
+        message["text"] = "/img یک گربه فضانورد روی ماه"
+    return types.Update.de_json({"update_id": n, "message": message})
+
+
+async def run_level(bot, telegram, scenario, concurrency, per_user, user_ids, update_ids):
+    """`concurrency` users each send `per_user` requests of `scenario`, one after another."""
+    latencies = []
+    calls_before = telegram.calls.copy()
+    errors_before, shed_before = telegram.errors, telegram.shed
+    lag = LoopLag()
+    lag.start()
+
+    async def user():
+        user_id = next(user_ids)
+        for _ in range(per_user):
+            update = build_update(next(update_ids), scenario, user_id, telegram)
+            started = time.monotonic()
+            await bot.process_new_updates([update])
+            latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+    await lag.stop()
+
+    calls = telegram.calls - calls_before
+    requests = len(latencies)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "seconds": round(elapsed, 3),
+        "throughput": round(requests / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "edits_per_response": round(calls["editMessageText"] / requests, 2) if requests else 0.0,
+        "api_calls_per_response": round(sum(calls.values()) / requests, 2) if requests else 0.0,
+        "errors": telegram.errors - errors_before,
+        "shed": telegram.shed - shed_before,
+        "loop_lag_p99_ms": round(percentile(lag.samples, 99) * 1000, 1),
+        "loop_lag_max_ms": round(max(lag.samples, default=0.0) * 1000, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1) if resource is not None else None,
+    }
+
+
+def load_bot(args, backend, workdir):
+    """Imports the bot with the fake Gemini client, keeping its data files in `workdir`."""
+    # config و gemini هنگام import فایل‌های پرامپت و کلیدها را می‌خوانند و فایل‌های داده را می‌سازند
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in PROMPT_FILES:
+        shutil.copy(os.path.join(here, name), workdir)
+    os.chdir(workdir)
+    os.environ["gemini_api_keys"] = ",".join(f"bench-key-{i}" for i in range(args.keys))
+    os.environ["tg_token"] = "1:bench"
+
+    import clients
+    clients.genai1.Client = backend.Client
+    import gemini
+    import main
+    gemini.client_pool.requests_per_minute = args.key_rpm
+    return gemini, main
+
+
+def print_table(results):
+    columns = (
+        ("scenario", "scenario", "{}"), ("conc", "concurrency", "{}"), ("reqs", "requests", "{}"),
+        ("req/s", "throughput", "{:.2f}"), ("p50 ms", "p50_ms", "{:.0f}"), ("p95 ms", "p95_ms", "{:.0f}"),
+        ("p99 ms", "p99_ms", "{:.0f}"), ("edits/resp", "edits_per_response", "{:.2f}"),
+        ("calls/resp", "api_calls_per_response", "{:.2f}"), ("errors", "errors", "{}"), ("shed", "shed", "{}"),
+        ("lag p99 ms", "loop_lag_p99_ms", "{:.1f}"), ("lag max ms", "loop_lag_max_ms", "{:.1f}"),
+        ("peak RSS MB", "peak_rss_mb", "{:.1f}"),
+    )
+    rows = [[title for title, _, _ in columns]]
+    for result in results:
+        rows.append(["-" if result[key] is None else fmt.format(result[key]) for _, key, fmt in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+async def run(args):
+    backend = FakeGemini(
+        first_chunk_seconds=args.first_chunk_ms / 1000,
+        chunk_seconds=args.chunk_ms / 1000,
+        chunks=args.chunks,
+        chunk_chars=args.chunk_chars,
+        image_seconds=args.image_ms / 1000,
+        image=_png(512),
+    )
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="bot-benchmark-")
+    try:
+        gemini, main = load_bot(args, backend, workdir)
+        from md2tgmd import escape
+        from config import conf
+
+        telegram = FakeTelegram(
+            args.telegram_latency_ms / 1000,
+            error_texts=(conf["error_info"], escape(conf["error_info"])),
+            overloaded_texts=(conf["overloaded_info"],),
+        )
+        telegram.files["photo"] = _jpeg(args.photo_side)
+        telegram.files["document"] = (ANSWER_TEXT * (args.document_bytes // len(ANSWER_TEXT.encode("utf-8")) + 1)).encode("utf-8")[:args.document_bytes]
+        telegram.install()
+
+        bot = AsyncTeleBot("1:bench")
+        main.register_handlers(bot)
+        main.register_metrics()
+        gemini.save_scheduler.start()
+
+        user_ids = itertools.count(10_000)
+        update_ids = itertools.count(1)
+        results = []
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                result = await run_level(bot, telegram, scenario, concurrency, args.per_user, user_ids, update_ids)
+                results.append(result)
+                print(f"{scenario} x{concurrency}: {result['throughput']} req/s, p95 {result['p95_ms']} ms", file=sys.stderr)
+
+        await gemini.save_scheduler.stop()
+        gemini.image_preprocessor.shutdown()
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load benchmark of the bot's handlers.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda value: [s for s in value.split(",") if s],
+                        help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", type=lambda value: [int(c) for c in value.split(",") if c],
+                        help="comma-separated numbers of concurrent users")
+    parser.add_argument("--per-user", type=int, default=3, help="requests each user sends, one after another")
+    parser.add_argument("--first-chunk-ms", type=float, default=300, help="model latency to the first streamed chunk")
+    parser.add_argument("--chunk-ms", type=float, default=50, help="time between streamed chunks")
+    parser.add_argument("--chunks", type=int, default=30, help="chunks per streamed answer")
+    parser.add_argument("--chunk-chars", type=int, default=60, help="characters per streamed chunk")
+    parser.add_argument("--image-ms", type=float, default=2000, help="latency of an image generation")
+    parser.add_argument("--telegram-latency-ms", type=float, default=30, help="latency of every Bot API call")
+    parser.add_argument("--photo-side", type=int, default=1280, help="width of the photos users send")
+    parser.add_argument("--document-bytes", type=int, default=20_000, help="size of the text documents users send")
+    parser.add_argument("--keys", type=int, default=4, help="number of fake Gemini API keys")
+    parser.add_argument("--key-rpm", type=int, default=0,
+                        help="requests per minute per key; 0 (the default) keeps key quotas out of the measurement")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
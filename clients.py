@@ -0,0 +1,299 @@
+import asyncio
+import random
+import re
+import time
+
+from google import genai as genai1
+
+from tracing import span
+
+
+def is_quota_error(error):
+    return getattr(error, "code", None) == 429 or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def retry_after(error):
+    """Seconds the API asked us to wait before retrying, if the error says so."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    details = getattr(error, "details", None)
+    try:
+        for detail in details["error"]["details"]:
+            if "retryDelay" in detail:
+                return float(str(detail["retryDelay"]).rstrip("s"))
+    except (KeyError, TypeError, ValueError):
+        pass
+    match = re.search(r"retry in ([\d.]+)\s*s", str(error), re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+
+class QuotaExhausted(Exception):
+    pass
+
+
+class TokenBucket:
+    """Requests-per-minute budget of one key for one model."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = max(rate_per_minute, 1)
+        self.rate = self.capacity / 60.0
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class KeyHealth:
+    """Observed latency, error rate, and per-model budget and cooldown of one API key."""
+
+    def __init__(self, key):
+        self.key = key
+        self.client = None
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttles = 0
+        self.buckets = {}
+        # model -> (cooldown end, consecutive 429 count)
+        self.cooldowns = {}
+
+    def cooling_until(self, model):
+        return self.cooldowns.get(model, (0.0, 0))[0]
+
+
+class ClientLease:
+    """One model call on a pooled client. release() records its outcome in the key's health."""
+
+    def __init__(self, pool, health, model):
+        self.pool = pool
+        self.health = health
+        self.model = model
+        self.client = health.client
+        self.key = health.key
+        self.started = time.monotonic()
+        self.first_response_at = None
+        self.released = False
+
+    def mark_first_response(self):
+        if self.first_response_at is None:
+            self.first_response_at = time.monotonic()
+
+    def release(self, error=None):
+        if not self.released:
+            self.released = True
+            self.pool._record(self, error)
+
+    def abandon(self):
+        """Frees the key's slot after a cancelled call; being cancelled says nothing about the key's health."""
+        if not self.released:
+            self.released = True
+            self.health.in_flight -= 1
+
+
+async def _prepend(first, chunks):
+    yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+async def _empty():
+    return
+    yield
+
+
+class ClientPool:
+    """
+    One long-lived genai client per API key, scheduled by health and per-model quota.
+
+    If `requests_per_minute` is set, every (key, model) pair has a token bucket
+    of that many requests; otherwise keys are limited only by their 429s. A key
+    that answers 429 for a model is cooled down for that model for as long as
+    the API's retry hint says, or with exponential backoff when there is none.
+    Among the keys that have budget left, keys are weighted by their latency
+    (time to the first response) and recent error rate. run() and stream()
+    retry a throttled call on another key, as long as nothing has been
+    received from the model yet, so the user never sees a quota error while
+    another key still has budget.
+    """
+
+    def __init__(self, api_keys, requests_per_minute=None, throttle_seconds=15, max_throttle_seconds=300,
+                 max_wait_seconds=10, alpha=0.2):
+        self.requests_per_minute = requests_per_minute
+        self.throttle_seconds = throttle_seconds
+        self.max_throttle_seconds = max_throttle_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.alpha = alpha
+        self.keys = {key: KeyHealth(key) for key in api_keys}
+        self.failovers = 0
+        self.observers = []  # observer(lease, error) is called for every released lease
+
+    def _client(self, health):
+        if health.client is None:
+            health.client = genai1.Client(api_key=health.key)
+        return health.client
+
+    def _bucket(self, health, model):
+        if not self.requests_per_minute:
+            return None
+        if model not in health.buckets:
+            health.buckets[model] = TokenBucket(self.requests_per_minute)
+        return health.buckets[model]
+
+    async def warm_up(self, model):
+        """Creates every client and opens its connection with a cheap request, so the first user doesn't pay for it."""
+        async def ping(health):
+            self._client(health)
+            try:
+                await health.client.aio.models.get(model=model)
+            except Exception as e:
+                print(f"Warm-up failed for API key ...{health.key[-4:]}: {e}")
+        await asyncio.gather(*(ping(health) for health in self.keys.values()))
+        print(f"Warmed up {len(self.keys)} Gemini clients.")
+
+    def _wait_time(self, health, model, now):
+        bucket = self._bucket(health, model)
+        return max(health.cooling_until(model) - now, bucket.wait_time(now) if bucket is not None else 0.0)
+
+    def _weight(self, health, model, now):
+        known = [h.latency for h in self.keys.values() if h.latency is not None]
+        latency = health.latency or (sum(known) / len(known) if known else 1.0)
+        bucket = self._bucket(health, model)
+        quota = bucket.tokens / bucket.capacity if bucket is not None else 1.0
+        return max(quota, 0.05) * (1 - health.error_rate) ** 2 / (latency * (1 + health.in_flight))
+
+    def _lease(self, health, model, now):
+        self._client(health)
+        bucket = self._bucket(health, model)
+        if bucket is not None:
+            bucket.take(now)
+        health.in_flight += 1
+        health.requests += 1
+        return ClientLease(self, health, model)
+
+    async def acquire(self, model, key=None, exclude=()):
+        """
+        Leases a client with budget left for `model`, waiting up to max_wait_seconds for one to free up.
+        `key` is preferred when it has budget (e.g. the key a chat session was created with).
+        """
+        candidates = [h for h in self.keys.values() if h.key not in exclude]
+        if not candidates:
+            raise QuotaExhausted("No Gemini API key is available.")
+        deadline = time.monotonic() + self.max_wait_seconds
+        while True:
+            now = time.monotonic()
+            preferred = self.keys.get(key)
+            if preferred in candidates and self._wait_time(preferred, model, now) == 0:
+                return self._lease(preferred, model, now)
+            ready = [h for h in candidates if self._wait_time(h, model, now) == 0]
+            if ready:
+                health = random.choices(ready, weights=[self._weight(h, model, now) for h in ready])[0]
+                return self._lease(health, model, now)
+            wait = min(self._wait_time(h, model, now) for h in candidates)
+            if now + wait > deadline:
+                raise QuotaExhausted(f"All Gemini API keys are rate limited for {model}; retry in {wait:.0f}s.")
+            await asyncio.sleep(wait)
+
+    async def run(self, model, call, key=None):
+        """Runs `await call(lease)` and retries it on another key when the key is throttled."""
+        tried = set()
+        with span("model_call"):
+            while True:
+                lease = await self.acquire(model, key=key, exclude=tried)
+                try:
+                    result = await call(lease)
+                except Exception as e:
+                    lease.release(e)
+                    if not is_quota_error(e) or len(tried) + 1 >= len(self.keys):
+                        raise
+                    tried.add(lease.key)
+                    self.failovers += 1
+                    continue
+                except BaseException:
+                    # لغو درخواست (قطع اتصال، لغو صف، خاموش شدن)
+                    lease.abandon()
+                    raise
+                lease.mark_first_response()
+                lease.release()
+                return result
+
+    async def stream(self, model, start, key=None):
+        """
+        Opens a streaming call with `await start(lease)` and waits for its first chunk,
+        retrying on another key while the key is throttled. Returns (lease, chunks);
+        the caller releases the lease once the stream is consumed,
+        or abandons it if it is cancelled.
+        """
+        tried = set()
+        with span("model_first_chunk"):
+            while True:
+                lease = await self.acquire(model, key=key, exclude=tried)
+                try:
+                    chunks = (await start(lease)).__aiter__()
+                    first = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return lease, _empty()
+                except Exception as e:
+                    lease.release(e)
+                    if not is_quota_error(e) or len(tried) + 1 >= len(self.keys):
+                        raise
+                    tried.add(lease.key)
+                    self.failovers += 1
+                    continue
+                except BaseException:
+                    lease.abandon()
+                    raise
+                lease.mark_first_response()
+                return lease, _prepend(first, chunks)
+
+    def _record(self, lease, error):
+        health = lease.health
+        health.in_flight -= 1
+        if error is not None:
+            health.errors += 1
+            if is_quota_error(error):
+                _, strikes = health.cooldowns.get(lease.model, (0.0, 0))
+                delay = retry_after(error)
+                if delay is None:
+                    delay = min(self.throttle_seconds * 2 ** strikes, self.max_throttle_seconds)
+                health.cooldowns[lease.model] = (time.monotonic() + delay, strikes + 1)
+                health.throttles += 1
+        elif lease.model in health.cooldowns:
+            del health.cooldowns[lease.model]
+        health.error_rate += self.alpha * ((1.0 if error is not None else 0.0) - health.error_rate)
+        if error is None or lease.first_response_at is not None:
+            latency = (lease.first_response_at or time.monotonic()) - lease.started
+            health.latency = latency if health.latency is None else health.latency + self.alpha * (latency - health.latency)
+        for observe in self.observers:
+            observe(lease, error)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            f"...{h.key[-4:]}": {
+                "requests": h.requests,
+                "errors": h.errors,
+                "throttles": h.throttles,
+                "in_flight": h.in_flight,
+                "latency_ms": round(h.latency * 1000, 1) if h.latency is not None else None,
+                "error_rate": round(h.error_rate, 3),
+                "tokens": {model: round(bucket.tokens, 1) for model, bucket in h.buckets.items()},
+                "cooling": [model for model in h.cooldowns if h.cooling_until(model) > now],
+            }
+            for h in self.keys.values()
+        }
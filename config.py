@@ -7,8 +7,9 @@ with open("default_image_processing_prompt.txt", "r", encoding="utf-8") as f:
     default_image_processing_prompt = f.read()
 
 
-default_image_processing_prompt = full_prompt + "\n\n" + default_image_processing_prompt
-default_file_processing_prompt = full_prompt + "\n\n" + """***قوانین مربوط به پردازش فایل***
+# پرامپت اصلی فقط یک بار (به عنوان system instruction کش‌شده) فرستاده می‌شود؛
+# قوانین تصویر و فایل فقط کنار درخواست مربوط می‌آیند و پرامپت اصلی را تکرار نمی‌کنند
+default_file_processing_prompt = """***قوانین مربوط به پردازش فایل***
 - اگر این متن رو میبینی یعنی تو درحال پردازش فایل برای کاربر هستی
 - فایل رو یا با توجه به کپشن کاربر پردازش کن
 - اگر کاربر برای فایلی کپششنی نگذاشته بود، تو محتوای فایل رو بطور خلاصه دربیار و برای خودت ذخیره کن"""
@@ -20,6 +21,60 @@ conf = {
     "model_2":              "gemini-2.0-flash-thinking-exp",
     "model_3":              "gemini-2.0-flash-preview-image-generation",
     "streaming_update_interval": 0.8,
+    "telegram_private_chat_interval": 1.0,
+    "telegram_group_chat_interval": 3.0,
+    "telegram_global_rate": 30,
+    "http_port": 8080,
+    "webhook_path": "/webhook",
+    "webhook_queue_size": 1000,
+    "webhook_max_connections": 40,
+    "journal_compact_bytes": 8 * 1024 * 1024,
+    "save_flush_interval": 2.0,
+    "save_flush_batch_size": 50,
+    "max_cached_users": 2000,
+    "chat_session_idle_seconds": 1800,
+    "user_cache_min_idle_seconds": 300,
+    # حداکثر درخواست همزمان و طول صف هر نوع کار؛ درخواست‌های بیشتر رد می‌شوند
+    "admission_limits": {
+        "text": {"concurrency": 32, "queue": 200},
+        "image": {"concurrency": 8, "queue": 50},
+        "voice": {"concurrency": 8, "queue": 50},
+        "file": {"concurrency": 4, "queue": 20},
+        "image_generation": {"concurrency": 2, "queue": 10},
+    },
+    "queue_position_info": "⏳ نوبت شما در صف: {}",
+    "overloaded_info": "🚦 ربات الان خیلی شلوغه! لطفاً چند دقیقه دیگه دوباره امتحان کن.",
+    # اختیاری: پیام‌های ادغام‌شده تا این مدت بعد از آخرین پیام منتظر پیام بعدی می‌مانند
+    "user_debounce_seconds": 0,
+    "user_max_merged_messages": 5,
+    # زمان‌بندی مراحل هر درخواست در این فایل JSON-lines نوشته می‌شود
+    "trace_log_file": "traces.jsonl",
+    "trace_keep_slowest": 20,
+    # اختیاری: سقف درخواست در دقیقه برای هر کلید و مدل (مثلا 10 برای کلید رایگان)؛
+    # None یا 0 یعنی بدون سقف و فقط استراحت کلید بعد از خطای 429
+    "gemini_key_rpm": None,
+    "gemini_key_max_wait_seconds": 10,
+    "membership_positive_ttl": 600,
+    "membership_negative_ttl": 30,
+    "media_cache_dir": "media_cache",
+    "media_cache_memory_bytes": 64 * 1024 * 1024,
+    "media_cache_disk_bytes": 512 * 1024 * 1024,
+    "media_spool_threshold_bytes": 1024 * 1024,
+    "image_workers": 2,
+    "image_targets": {
+        "describe": {"max_side": 1536, "format": "JPEG", "quality": 85},
+        "edit": {"max_side": 2048, "format": "JPEG", "quality": 92, "full_resolution": True},
+    },
+    "context_budget_tokens": 100_000,
+    "context_keep_recent_entries": 6,
+    "context_media_keep_entries": 2,
+    "context_summary_prompt": "خلاصه‌ای کوتاه و دقیق از گفتگوی زیر بنویس که نکات مهم، اطلاعات کاربر و تصمیم‌ها را نگه دارد. اگر خلاصه فعلی داده شده، آن را با پیام‌های جدید به‌روز کن. فقط خلاصه را بنویس.",
+    "prompt_cache_enabled": True,
+    "prompt_cache_ttl_seconds": 3600,
+    # کش پاسخ‌ها اختیاری است؛ هر نوع درخواست با TTL بزرگ‌تر از صفر کش می‌شود
+    # با کش group_text، پرسش‌های گروه بدون تاریخچه گفتگوی پرسنده پاسخ داده می‌شوند
+    "response_cache_ttl_seconds": {"draw": 0, "edit": 0, "group_text": 0},
+    "response_cache_max_entries": 1000,
     "default_system_prompt": full_prompt,
     "default_image_processing_prompt": default_image_processing_prompt,
     "persian_messages": {
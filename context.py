@@ -0,0 +1,207 @@
+import asyncio
+
+
+SUMMARY_PREFIX = "خلاصه بخش‌های قبلی این گفتگو:\n"
+SUMMARY_ACK = "باشه، خلاصه گفتگوی قبلی را به خاطر سپردم."
+MEDIA_NOTE = "[فایل قدیمی از این پیام حذف شد]"
+
+
+def _field(obj, name):
+    """Reads a field of a history entry or part, whether it is a dict or a genai types object."""
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def _is_media(part):
+    return any(_field(part, name) is not None for name in ("inline_data", "file_data", "file_ref"))
+
+
+def entry_role(entry):
+    return _field(entry, "role")
+
+
+def entry_text(entry):
+    """The text parts of a history entry joined together; media parts become a short note."""
+    texts = []
+    for part in _field(entry, "parts") or ():
+        if _field(part, "text"):
+            texts.append(_field(part, "text"))
+        elif _is_media(part):
+            texts.append("[فایل]")
+    return "\n".join(texts)
+
+
+class ContextManager:
+    """
+    Keeps the contents of a model request within a token budget.
+
+    Tokens are estimated from text length and media size, which is close enough
+    to budget with. While a history fits, it is sent unchanged. Once it is over
+    budget, media parts older than the newest `media_keep_entries` entries are
+    replaced by a note and the oldest turns after the system prompt are left
+    out. At least `keep_recent_entries` entries are always kept. The left-out
+    turns are folded into a rolling summary in the background by
+    `summarize(previous_summary, entries)`. The summary is kept as a user/model
+    pair right after the system prompt, so it survives like any other history.
+    """
+
+    def __init__(self, summarize, budget_tokens=100_000, keep_recent_entries=6, media_keep_entries=2,
+                 preamble_entries=2, chars_per_token=3, media_tokens=1000):
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.keep_recent_entries = keep_recent_entries
+        self.media_keep_entries = media_keep_entries
+        self.preamble_entries = preamble_entries
+        self.chars_per_token = chars_per_token
+        self.media_tokens = media_tokens
+        self._folding = {}
+        # owner -> (entries, apply) waiting for the owner's running fold to finish
+        self._queued = {}
+        self.trimmed_requests = 0
+        self.folds = 0
+        self.fold_errors = 0
+
+    # ---------- estimates ----------
+
+    def part_tokens(self, part):
+        text = _field(part, "text")
+        if text:
+            return len(text) // self.chars_per_token + 1
+        inline = _field(part, "inline_data")
+        if inline is not None:
+            data = _field(inline, "data") or b""
+            return max(258, len(data) // 100)
+        if _is_media(part):
+            return self.media_tokens
+        return 1
+
+    def entry_tokens(self, entry):
+        parts = entry if isinstance(entry, (list, tuple)) else _field(entry, "parts") or ()
+        return sum(self.part_tokens(part) for part in parts) + 4
+
+    def tokens(self, history):
+        return sum(self.entry_tokens(entry) for entry in history)
+
+    # ---------- summary ----------
+
+    def preamble_length(self, history):
+        """Entries that are always sent: the system prompt pair and, if present, the summary pair."""
+        p = min(self.preamble_entries, len(history))
+        if len(history) >= p + 2 and entry_text(history[p]).startswith(SUMMARY_PREFIX):
+            p += 2
+        return p
+
+    def summary(self, history):
+        p = min(self.preamble_entries, len(history))
+        if self.preamble_length(history) > p:
+            return entry_text(history[p])[len(SUMMARY_PREFIX):]
+        return None
+
+    def with_summary(self, history, summary, folded=()):
+        """The history with its summary pair replaced by `summary` and the folded entries left out."""
+        folded_ids = {id(entry) for entry in folded}
+        p = self.preamble_length(history)
+        pair = [
+            {'role': 'user', 'parts': [{'text': SUMMARY_PREFIX + summary}]},
+            {'role': 'model', 'parts': [{'text': SUMMARY_ACK}]},
+        ]
+        rest = [entry for entry in history[p:] if id(entry) not in folded_ids]
+        return list(history[:self.preamble_entries]) + pair + rest
+
+    # ---------- fitting ----------
+
+    def _strip_media(self, entry):
+        parts = _field(entry, "parts") or ()
+        if not any(_is_media(part) for part in parts):
+            return entry
+        new_parts = []
+        for part in parts:
+            if _is_media(part):
+                new_parts.append({'text': MEDIA_NOTE})
+            elif isinstance(part, dict):
+                new_parts.append(part)
+            else:
+                new_parts.append(part.model_dump(exclude_none=True))
+        return {'role': _field(entry, "role"), 'parts': new_parts}
+
+    def fit(self, history, extra_tokens=0):
+        """
+        Returns (contents, folded): the history as it should be sent along with
+        `extra_tokens` worth of new input, and the older entries left out of it.
+        """
+        if self.tokens(history) + extra_tokens <= self.budget_tokens:
+            return history, []
+        self.trimmed_requests += 1
+        p = self.preamble_length(history)
+        body = history[p:]
+        budget = self.budget_tokens - extra_tokens - self.tokens(history[:p])
+        media_cutoff = len(body) - self.media_keep_entries
+        kept = []
+        used = 0
+        for i in range(len(body) - 1, -1, -1):
+            entry = self._strip_media(body[i]) if i < media_cutoff else body[i]
+            cost = self.entry_tokens(entry)
+            if used + cost > budget and len(kept) >= self.keep_recent_entries:
+                break
+            kept.append(entry)
+            used += cost
+        kept.reverse()
+        start = len(body) - len(kept)
+        # گفتگو باید با پیام کاربر شروع شود
+        while kept and entry_role(kept[0]) != "user":
+            kept.pop(0)
+            start += 1
+        return list(history[:p]) + kept, list(body[:start])
+
+    # ---------- background folding ----------
+
+    def fold(self, owner, history, folded, apply):
+        """
+        Summarizes `folded` together with the history's current summary in the background,
+        then calls apply(summary, folded_entries). Only one fold runs per owner at a time;
+        entries folded meanwhile are summarized right after it, on top of its summary.
+        """
+        if not folded:
+            return
+        running = self._folding.get(owner)
+        if running is not None:
+            seen = {id(entry) for entry in running[1]}
+            queued_entries, _ = self._queued.get(owner, ([], None))
+            seen.update(id(entry) for entry in queued_entries)
+            queued_entries = queued_entries + [entry for entry in folded if id(entry) not in seen]
+            self._queued[owner] = (queued_entries, apply)
+            return
+        self._start_fold(owner, self.summary(history), folded, apply)
+
+    def _start_fold(self, owner, previous, folded, apply):
+        self._folding[owner] = (asyncio.create_task(self._fold(owner, previous, folded, apply)), folded)
+
+    async def _fold(self, owner, previous, folded, apply):
+        summary = None
+        try:
+            summary = await self.summarize(previous, folded)
+            if summary:
+                apply(summary, folded)
+                self.folds += 1
+        except Exception as e:
+            self.fold_errors += 1
+            print(f"Error summarizing the conversation of {owner}: {e}")
+        finally:
+            self._folding.pop(owner, None)
+            queued = self._queued.pop(owner, None)
+            if queued and queued[0]:
+                entries, queued_apply = queued
+                if not summary:
+                    # خلاصه قبلی اعمال نشد؛ پیام‌هایش همراه پیام‌های بعدی خلاصه می‌شوند
+                    entries = folded + entries
+                self._start_fold(owner, summary or previous, entries, queued_apply)
+
+    def stats(self):
+        return {
+            "budget_tokens": self.budget_tokens,
+            "trimmed_requests": self.trimmed_requests,
+            "folds": self.folds,
+            "folding": len(self._folding),
+            "fold_errors": self.fold_errors,
+        }
@@ -0,0 +1,213 @@
+import asyncio
+import time
+
+from telebot.asyncio_helper import ApiTelegramException
+
+
+class _Frame:
+    __slots__ = ("text", "parse_mode", "fallback_text", "future", "final")
+
+    def __init__(self, text, parse_mode, fallback_text, future, final=False):
+        self.text = text
+        self.parse_mode = parse_mode
+        self.fallback_text = fallback_text
+        self.future = future
+        self.final = final
+
+
+class EditScheduler:
+    """
+    Single outbound scheduler for streamed message edits.
+
+    Every edit or send reserves a slot that respects a per-chat interval
+    (Telegram allows about one message per second in a private chat and 20 per
+    minute in a group) and a global messages-per-second cap. Streams submit the
+    newest content of their message with submit(); if a previous frame of the
+    same message is still waiting for its slot it is replaced, so only the
+    latest text is ever sent. The per-chat interval only throttles the frames
+    of a stream: its final edit waits just for flood waits and the global cap,
+    so a finished answer is never left truncated on screen. A 429 flood wait
+    pushes that chat's next slot back by `retry_after` instead of stalling
+    every other handler.
+    """
+
+    def __init__(self, min_interval=0.8, private_interval=1.0, group_interval=3.0, global_rate=30, max_retries=3):
+        self.min_interval = min_interval
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self.global_rate = global_rate
+        self.max_retries = max_retries
+        self._chat_next = {}
+        self._flood_until = {}  # chat -> end of its 429 flood wait
+        self._wakeups = {}  # message -> event set when its final frame is submitted
+        self._global_next = 0.0
+        self._pending = {}
+        self._workers = {}
+        self._recent = {}
+        self.sent = 0
+        self.superseded = 0
+        self.flood_waits = 0
+        self.errors = 0
+
+    def chat_interval(self, chat_id):
+        return self.group_interval if chat_id < 0 else self.private_interval
+
+    def active_streams(self):
+        now = time.monotonic()
+        for key in [key for key, seen in self._recent.items() if now - seen > 5]:
+            del self._recent[key]
+        return len(self._recent)
+
+    def frame_interval(self, chat_id):
+        """How often a stream in this chat should render a new frame under the current load."""
+        return max(self.min_interval, self.chat_interval(chat_id), self.active_streams() / self.global_rate)
+
+    def _take_slot(self, chat_id, final=False):
+        """Reserves the chat's next send slot and returns its time. A final edit skips the per-chat interval."""
+        now = time.monotonic()
+        if final:
+            flood_until = self._flood_until.get(chat_id, 0.0)
+            if flood_until <= now:
+                self._flood_until.pop(chat_id, None)
+            slot = max(now, flood_until, self._global_next)
+            self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0.0), slot + self.chat_interval(chat_id))
+        else:
+            slot = max(now, self._chat_next.get(chat_id, 0.0), self._global_next)
+            self._chat_next[chat_id] = slot + self.chat_interval(chat_id)
+        self._global_next = slot + 1 / self.global_rate
+        return slot
+
+    async def _reserve(self, chat_id, final=False):
+        delay = self._take_slot(chat_id, final) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _wait_slot(self, key):
+        """Waits for the slot of a message's next frame; stops waiting early if its final frame arrives."""
+        chat_id = key[0]
+        frame = self._pending.get(key)
+        final = frame is not None and frame.final
+        delay = self._take_slot(chat_id, final) - time.monotonic()
+        if delay <= 0:
+            return
+        if final:
+            await asyncio.sleep(delay)
+            return
+        wakeup = self._wakeups[key] = asyncio.Event()
+        try:
+            await asyncio.wait_for(wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            return
+        finally:
+            self._wakeups.pop(key, None)
+        # فریم نهایی جای فریم منتظر را گرفته و منتظر فاصله چت نمی‌ماند
+        await self._reserve(chat_id, final=True)
+
+    def _flood_wait(self, chat_id, error):
+        retry_after = (error.result_json.get("parameters") or {}).get("retry_after", 1)
+        self.flood_waits += 1
+        until = time.monotonic() + retry_after
+        self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0.0), until)
+        self._flood_until[chat_id] = max(self._flood_until.get(chat_id, 0.0), until)
+
+    # ---------- edits ----------
+
+    def submit(self, bot, chat_id, message_id, text, parse_mode=None, fallback_text=None, wait=False, final=False):
+        """
+        Queues the newest content of a message. A frame of the same message that is
+        still waiting is dropped. With wait=True returns a future of the edit result.
+        A final frame (the finished answer) is not held back by the per-chat interval.
+        """
+        key = (chat_id, message_id)
+        future = asyncio.get_running_loop().create_future() if wait else None
+        old = self._pending.get(key)
+        if old is not None:
+            self.superseded += 1
+            if old.future is not None and not old.future.done():
+                old.future.set_result(None)
+        self._pending[key] = _Frame(text, parse_mode, fallback_text, future, final)
+        self._recent[key] = time.monotonic()
+        if final and key in self._wakeups:
+            self._wakeups[key].set()
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._deliver(bot, key))
+        return future
+
+    async def edit(self, bot, chat_id, message_id, text, parse_mode=None, fallback_text=None, final=False):
+        """Edits a message after every earlier frame of it, waiting for its slot. Errors are raised to the caller."""
+        return await self.submit(bot, chat_id, message_id, text, parse_mode, fallback_text, wait=True, final=final)
+
+    async def _deliver(self, bot, key):
+        chat_id, message_id = key
+        try:
+            while key in self._pending:
+                await self._wait_slot(key)
+                frame = self._pending.pop(key, None)
+                if frame is None:
+                    break
+                try:
+                    result = await self._edit_frame(bot, key, frame)
+                except Exception as e:
+                    self.errors += 1
+                    if frame.future is not None:
+                        if not frame.future.done():
+                            frame.future.set_exception(e)
+                    else:
+                        print(f"Error editing streamed message {message_id} in chat {chat_id}: {e}")
+                else:
+                    if frame.future is not None and not frame.future.done():
+                        frame.future.set_result(result)
+        finally:
+            self._workers.pop(key, None)
+
+    async def _edit_frame(self, bot, key, frame):
+        chat_id, message_id = key
+        text, parse_mode = frame.text, frame.parse_mode
+        for _ in range(self.max_retries):
+            try:
+                result = await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, parse_mode=parse_mode)
+                self.sent += 1
+                return result
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    self._flood_wait(chat_id, e)
+                    if key in self._pending:
+                        # فریم جدیدتری در صف است؛ این فریم دیگر ارزشی ندارد
+                        self.superseded += 1
+                        return None
+                    await self._reserve(chat_id, frame.final)
+                    continue
+                if "message is not modified" in str(e).lower():
+                    return None
+                if parse_mode and frame.fallback_text is not None:
+                    # خطای قالب‌بندی MarkdownV2؛ متن ساده ارسال می‌شود
+                    text, parse_mode = frame.fallback_text, None
+                    continue
+                raise
+        raise RuntimeError(f"Gave up editing message {message_id} in chat {chat_id} after repeated flood waits.")
+
+    # ---------- new messages ----------
+
+    async def send_message(self, bot, chat_id, text, **kwargs):
+        """Sends a message in its chat's next slot, waiting out flood limits."""
+        for _ in range(self.max_retries):
+            await self._reserve(chat_id)
+            try:
+                result = await bot.send_message(chat_id, text, **kwargs)
+                self.sent += 1
+                return result
+            except ApiTelegramException as e:
+                if e.error_code != 429:
+                    raise
+                self._flood_wait(chat_id, e)
+        raise RuntimeError(f"Gave up sending a message to chat {chat_id} after repeated flood waits.")
+
+    def stats(self):
+        return {
+            "active_streams": self.active_streams(),
+            "pending_frames": len(self._pending),
+            "sent": self.sent,
+            "superseded": self.superseded,
+            "flood_waits": self.flood_waits,
+            "errors": self.errors,
+        }
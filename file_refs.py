@@ -0,0 +1,134 @@
+import asyncio
+import io
+import time
+
+from media_cache import MediaFile
+from tracing import span
+
+
+MISSING_FILE_TEXT = "[فایل قبلی دیگر در دسترس نیست]"
+
+
+class FileRefs:
+    """
+    Gemini Files API uploads of user media, so history refers to a file instead of carrying its bytes.
+
+    History stores a compact part {'file_ref': {'id': file_unique_id, 'mime_type': ...}}.
+    Uploaded files belong to the API key that uploaded them and expire after
+    about two days, so resolve() turns every reference into a file_data part for
+    the key of the current lease: each (key, file) pair is uploaded once and
+    again only after its upload has expired. The bytes for a re-upload come from
+    the media cache's disk tier; a file that is no longer cached is replaced by a
+    short note.
+    """
+
+    def __init__(self, media_cache, ttl_seconds=47 * 3600, expiry_margin_seconds=3600):
+        self.media_cache = media_cache
+        self.ttl_seconds = ttl_seconds
+        self.expiry_margin_seconds = expiry_margin_seconds
+        self._uploads = {}  # (api_key, file id) -> (uri, expires_at)
+        self._inflight = {}
+        self.uploads = 0
+        self.reuses = 0
+        self.expired = 0
+        self.missing = 0
+
+    @staticmethod
+    def part(file_id, mime_type):
+        return {'file_ref': {'id': file_id, 'mime_type': mime_type}}
+
+    async def uri(self, lease, file_id, mime_type, source=None):
+        """The URI of the file on the lease's key, uploading `source` (bytes or MediaFile) or the cached copy if needed."""
+        key = (lease.key, file_id)
+        entry = self._uploads.get(key)
+        if entry is not None:
+            if entry[1] > time.time():
+                self.reuses += 1
+                return entry[0]
+            self.expired += 1
+            del self._uploads[key]
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._upload(lease, file_id, mime_type, source))
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _upload(self, lease, file_id, mime_type, source):
+        try:
+            if isinstance(source, MediaFile):
+                file = source.path
+            elif source is not None:
+                file = io.BytesIO(source)
+            else:
+                file = self.media_cache.cached_path(file_id)
+                if file is None:
+                    raise FileNotFoundError(f"{file_id} is no longer in the media cache.")
+            with span("file_upload"):
+                uploaded = await lease.client.aio.files.upload(file=file, config={'mime_type': mime_type})
+                while uploaded.state == "PROCESSING":
+                    await asyncio.sleep(1)
+                    uploaded = await lease.client.aio.files.get(name=uploaded.name)
+            if uploaded.state == "FAILED":
+                raise RuntimeError(f"Gemini could not process the uploaded file {uploaded.name}.")
+            expiration = getattr(uploaded, "expiration_time", None)
+            expires_at = expiration.timestamp() - self.expiry_margin_seconds if expiration else time.time() + self.ttl_seconds
+            self._uploads[(lease.key, file_id)] = (uploaded.uri, expires_at)
+            self.uploads += 1
+            return uploaded.uri
+        finally:
+            self._inflight.pop((lease.key, file_id), None)
+
+    async def resolve(self, lease, contents, sources=None):
+        """
+        A copy of `contents` in which every file_ref part is a file_data part usable with
+        the lease's key. `sources` maps file ids to bytes or a MediaFile for files that
+        may not be cached yet.
+        """
+        refs = {}
+        for turn in contents:
+            for part in turn.get('parts', ()) if isinstance(turn, dict) else ():
+                if isinstance(part, dict) and 'file_ref' in part:
+                    refs[part['file_ref']['id']] = part['file_ref']['mime_type']
+        if not refs:
+            return contents
+        ids = list(refs)
+        results = await asyncio.gather(
+            *(self.uri(lease, file_id, refs[file_id], (sources or {}).get(file_id)) for file_id in ids),
+            return_exceptions=True,
+        )
+        uris = {}
+        for file_id, result in zip(ids, results):
+            if isinstance(result, FileNotFoundError):
+                self.missing += 1
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                uris[file_id] = result
+
+        resolved = []
+        for turn in contents:
+            parts = turn.get('parts') if isinstance(turn, dict) else None
+            if not parts or not any(isinstance(part, dict) and 'file_ref' in part for part in parts):
+                resolved.append(turn)
+                continue
+            new_parts = []
+            for part in parts:
+                if isinstance(part, dict) and 'file_ref' in part:
+                    ref = part['file_ref']
+                    if ref['id'] in uris:
+                        new_parts.append({'file_data': {'file_uri': uris[ref['id']], 'mime_type': ref['mime_type']}})
+                    else:
+                        new_parts.append({'text': MISSING_FILE_TEXT})
+                else:
+                    new_parts.append(part)
+            resolved.append({**turn, 'parts': new_parts})
+        return resolved
+
+    def stats(self):
+        return {
+            "uploaded_files": len(self._uploads),
+            "uploads": self.uploads,
+            "reuses": self.reuses,
+            "expired": self.expired,
+            "missing": self.missing,
+        }
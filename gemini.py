@@ -1,19 +1,27 @@
-import random
-import io
 import traceback
 import asyncio
+from functools import wraps
 from datetime import datetime, timezone, timedelta, time as dt_time
-from PIL import Image
 from telebot import TeleBot
 from dotenv import load_dotenv
 import os
 from telebot.types import Message
-import aiofiles
-import json
-import time
-from google import genai as genai1
 from md2tgmd import escape
 from config import conf, safety_settings, generation_config
+from storage import ChatStore, SaveScheduler
+from user_cache import UserCache
+from clients import ClientPool
+from edit_scheduler import EditScheduler
+from streaming import StreamEngine, StreamStats
+from media_cache import MediaCache, MediaFile
+from file_refs import FileRefs
+from context import ContextManager, MEDIA_NOTE, entry_role, entry_text
+from images import ImagePreprocessor
+from prompt_cache import PromptCache
+from response_cache import ResponseCache
+from user_queue import UserQueue
+from admission import AdmissionController, Overloaded
+from tracing import Tracer, span
 
 
 PRO_MODELS = {
@@ -28,37 +36,138 @@ error_info = conf["error_info"]
 before_generate_info = conf["before_generate_info"]
 download_pic_notify = conf["download_pic_notify"]
 default_system_prompt = conf.get("default_system_prompt", "").strip()
-default_image_processing_prompt = conf.get("default_image_processing_prompt", "")
 default_image_prompt = conf.get("default_image_prompt", "این تصویر را توصیف کن.")
 active_users_today = set()
 
 load_dotenv()
-GEMINI_API_KEYS = os.getenv("gemini_api_keys", "").split(",")
+GEMINI_API_KEYS = [key.strip() for key in os.getenv("gemini_api_keys", "").split(",") if key.strip()]
+client_pool = ClientPool(
+    GEMINI_API_KEYS,
+    requests_per_minute=conf["gemini_key_rpm"],
+    max_wait_seconds=conf["gemini_key_max_wait_seconds"],
+)
 
-user_chats = {}
 USER_CHATS_FILE = "user_chats_data.json"
-_save_lock = asyncio.Lock()
-
-
+USER_CHATS_INDEX = "user_chats_index.json"
+USER_CHATS_JOURNAL = "user_chats_journal.jsonl"
+DAILY_STATS = ("generated_images", "edited_images", "voices")
+chat_store = ChatStore(USER_CHATS_INDEX, USER_CHATS_JOURNAL, conf["journal_compact_bytes"], legacy_snapshot_path=USER_CHATS_FILE)
+user_chats = UserCache(
+    chat_store,
+    max_users=conf["max_cached_users"],
+    session_idle_seconds=conf["chat_session_idle_seconds"],
+    min_idle_seconds=conf["user_cache_min_idle_seconds"],
+)
+edit_scheduler = EditScheduler(
+    min_interval=conf["streaming_update_interval"],
+    private_interval=conf["telegram_private_chat_interval"],
+    group_interval=conf["telegram_group_chat_interval"],
+    global_rate=conf["telegram_global_rate"],
+)
+media_cache = MediaCache(
+    conf["media_cache_dir"],
+    memory_bytes=conf["media_cache_memory_bytes"],
+    disk_bytes=conf["media_cache_disk_bytes"],
+)
+file_refs = FileRefs(media_cache)
+image_preprocessor = ImagePreprocessor(conf["image_targets"], workers=conf["image_workers"])
+prompt_cache = PromptCache(
+    {"chat": default_system_prompt},
+    ttl_seconds=conf["prompt_cache_ttl_seconds"],
+    enabled=conf["prompt_cache_enabled"],
+)
+
+
+async def _summarize_turns(previous_summary, entries):
+    """Folds older turns of a conversation into its rolling summary with the fast model."""
+    lines = [f"خلاصه فعلی:\n{previous_summary}"] if previous_summary else []
+    for entry in entries:
+        sender = "کاربر" if entry_role(entry) == "user" else "دستیار"
+        lines.append(f"{sender}: {entry_text(entry)}")
+    prompt = conf["context_summary_prompt"] + "\n\n" + "\n\n".join(lines)
+    response = await client_pool.run(
+        model_1,
+        lambda lease: lease.client.aio.models.generate_content(model=model_1, contents=prompt),
+    )
+    return (response.text or "").strip()
+
+
+response_cache = ResponseCache(
+    conf["response_cache_ttl_seconds"],
+    max_entries=conf["response_cache_max_entries"],
+)
+context_manager = ContextManager(
+    _summarize_turns,
+    budget_tokens=conf["context_budget_tokens"],
+    keep_recent_entries=conf["context_keep_recent_entries"],
+    media_keep_entries=conf["context_media_keep_entries"],
+)
+stream_stats = StreamStats()
+admission = AdmissionController(conf["admission_limits"])
+stream_engine = StreamEngine(
+    client_pool,
+    edit_scheduler,
+    stats=stream_stats,
+    status_text=before_generate_info,
+    empty_text="پاسخی دریافت نشد.",
+    error_text=error_info,
+    admission=admission,
+    position_text=conf["queue_position_info"],
+    overloaded_text=conf["overloaded_info"],
+)
+user_queue = UserQueue(
+    debounce_seconds=conf["user_debounce_seconds"],
+    max_merged=conf["user_max_merged_messages"],
+)
+tracer = Tracer(conf["trace_log_file"], keep_slowest=conf["trace_keep_slowest"])
+save_scheduler = SaveScheduler(
+    lambda user_ids: chat_store.save(user_chats, user_ids),
+    interval=conf["save_flush_interval"],
+    batch_size=conf["save_flush_batch_size"],
+)
+
+
+
+
+_history_sizes = {}  # user -> (id of the history list, entries, bytes)
+
+
+def _part_bytes(part):
+    if part.get('text'):
+        return len(part['text'].encode("utf-8"))
+    if part.get('inline_data'):
+        return len(part['inline_data'].get('data') or b"")
+    return 0
+
+
+def history_bytes():
+    """
+    Approximate bytes taken by the stored histories of the users in memory. A history
+    is only measured again once it was replaced or its length changed.
+    """
+    sizes = {}
+    for user_id, data in user_chats.items():
+        history = data.get("history") or []
+        size = _history_sizes.get(user_id)
+        if size is None or size[0] != id(history) or size[1] != len(history):
+            total = sum(
+                _part_bytes(part)
+                for entry in history if isinstance(entry, dict)
+                for part in entry.get('parts', ()) if isinstance(part, dict)
+            )
+            size = (id(history), len(history), total)
+        sizes[user_id] = size
+    _history_sizes.clear()
+    _history_sizes.update(sizes)
+    return sum(size[2] for size in sizes.values())
 
 
-def split_long_message(text, max_length=4000):
-    """تقسیم متن به بخش‌هایی با حداکثر max_length کاراکتر"""
-    if len(text) <= max_length:
-        return [text]
-    parts = []
-    while len(text) > max_length:
-        split_index = text.rfind('\n', 0, max_length)
-        if split_index == -1 or split_index < max_length // 2:
-            split_index = max_length
-        parts.append(text[:split_index])
-        text = text[split_index:].lstrip()
-    if text:
-        parts.append(text)
-    return parts
+def get_user_data(user_id_str):
+    """Returns the user's in-memory data, loading it from disk on first access. None for unknown users."""
+    return user_chats.get_or_load(user_id_str)
 
 def _initialize_user(user_id_str):
-    if user_id_str not in user_chats:
+    if get_user_data(user_id_str) is None:
         user_chats[user_id_str] = {
             "history": [],
             "stats": {"messages": 0, "generated_images": 0, "edited_images": 0, "voices": 0, "files": 0}
@@ -68,41 +177,29 @@ def _initialize_user(user_id_str):
     if "history" not in user_chats[user_id_str]:
         user_chats[user_id_str]["history"] = []
 
-async def save_user_chats():
-    async with _save_lock:
-        try:
-            save_data = {}
-            for uid, data in user_chats.items():
-                # Do not save the chat session object, only serializable data
-                history_to_save = data.get("history", [])
-                stats_to_save = data.get("stats", {"messages": 0, "generated_images": 0, "edited_images": 0})
-                save_data[uid] = {
-                    "history": history_to_save,
-                    "stats": stats_to_save
-                }
-            async with aiofiles.open(USER_CHATS_FILE, "w", encoding="utf-8") as f:
-                await f.write(json.dumps(save_data, ensure_ascii=False, indent=2))
-        except Exception as e:
-            print(f"Error saving user chats to file: {e}")
+async def save_user_chats(*user_ids):
+    """Persists the given users (every loaded user if none are given); only changes since the last save are written."""
+    try:
+        await chat_store.save(user_chats, user_ids or None)
+    except Exception as e:
+        print(f"Error saving user chats to file: {e}")
+
+
+def mark_user_dirty(user_id):
+    """Queues the user for the next write-behind flush instead of saving immediately."""
+    save_scheduler.mark_dirty(user_id)
 
 
 async def load_user_chats_async():
-    global user_chats
-    user_chats = {}
-    print("Initialized in-memory user_chats dictionary.")
-    if os.path.exists(USER_CHATS_FILE):
-        try:
-            async with aiofiles.open(USER_CHATS_FILE, "r", encoding="utf-8") as f:
-                content = await f.read()
-                loaded_data = json.loads(content)
-                for uid, data in loaded_data.items():
-                     _initialize_user(uid)
-                     user_chats[uid]["history"] = data.get("history", [])
-                     user_chats[uid]["stats"] = data.get("stats", {"messages": 0, "generated_images": 0, "edited_images": 0})
-            print(f"Successfully loaded chat data for {len(user_chats)} users.")
-        except Exception as e:
-            print(f"Error loading user chats from file: {e}")
-            user_chats = {}
+    user_chats.clear()
+    print("Initialized in-memory user_chats cache.")
+    try:
+        # فقط ایندکس خوانده می‌شود؛ تاریخچه هر کاربر در اولین پیامش بارگذاری می‌شود
+        await chat_store.load()
+        print(f"Indexed chat data for {chat_store.user_count} users.")
+    except Exception as e:
+        print(f"Error loading user chats from file: {e}")
+        user_chats.clear()
 
 
 async def daily_reset_stats():
@@ -115,237 +212,226 @@ async def daily_reset_stats():
         print(f"ریست روزانه در {seconds_until_midnight / 3600:.2f} ساعت دیگر.")
         await asyncio.sleep(seconds_until_midnight)
         print("Performing daily stat reset...")
-        async with _save_lock:
-            for user_id in user_chats:
-                if "stats" in user_chats.get(user_id, {}):
-                    user_chats[user_id]["stats"]["generated_images"] = 0
-                    user_chats[user_id]["stats"]["edited_images"] = 0
-                    user_chats[user_id]["stats"]["voices"] = 0
-            await save_user_chats()
+        # values() کاربران را «تازه استفاده‌شده» علامت نمی‌زند
+        for data in user_chats.values():
+            if "stats" in data:
+                for key in DAILY_STATS:
+                    data["stats"][key] = 0
+        # کاربرانی که در حافظه نیستند هنگام بارگذاری ریست می‌شوند
+        await chat_store.record_daily_reset(DAILY_STATS)
+        await save_user_chats()
         print("Daily stat reset complete.")
         await asyncio.sleep(1)
 
 
 search_tool = {'google_search': {}}
 
-def get_random_client():
-    api_key = random.choice(os.getenv("gemini_api_keys", "").split(","))
-    return genai1.Client(api_key=api_key)
+def _user_preamble(message):
+    """
+    The first turns of a new conversation: the short per-user part of the system prompt
+    (name, date and time). The large static prompt goes to the model through prompt_cache.
+    """
+    first_name = message.from_user.first_name or "کاربر"
+    tz = timezone(timedelta(hours=3, minutes=30))
+    now = datetime.now(tz)
+    return [
+        {'role': 'user', 'parts': [{'text': f"نام کاربر: {first_name}\nتاریخ: {now:%d/%m/%Y}\nزمان: {now:%H:%M:%S}"}]},
+        {'role': 'model', 'parts': [{'text': "باشه، متوجه شدم. آماده‌ام."}]}
+    ]
 
-# تابع کمکی برای مدیریت استریم پاسخ از کتابخانه google-genai
-async def _handle_response_streaming_genai1(response_stream, sent_message, bot):
-    """Handles streaming responses from the google-genai library."""
-    full_response = ""
-    last_update = time.time()
-    update_interval = conf["streaming_update_interval"]
-    try:
-        async for chunk in response_stream:
-            if hasattr(chunk, 'text') and chunk.text:
-                full_response += chunk.text
-                current_time = time.time()
-                if current_time - last_update >= update_interval and full_response.strip():
-                    text_to_send = escape(full_response + "✍️")
-                    try:
-                        await bot.edit_message_text(text_to_send, chat_id=sent_message.chat.id, message_id=sent_message.message_id, parse_mode="MarkdownV2")
-                    except Exception as e:
-                        if "message is not modified" not in str(e).lower():
-                            # Fallback to sending without MarkdownV2 if escaping fails
-                            await bot.edit_message_text(full_response + "✍️", chat_id=sent_message.chat.id, message_id=sent_message.message_id)
-                    last_update = current_time
-    except Exception as e:
-        print(f"Error during streaming with genai1: {e}")
-    return full_response
 
-async def gemini_stream(bot: TeleBot, message: Message, m: str, model_type: str):
-    user_id = str(message.from_user.id)
-    _initialize_user(user_id)
-    sent_message = None
-    try:
-        client = get_random_client()
-        chat_session_key = 'chat_session'
-        chat_model_key = 'chat_model'
-        chat_session = user_chats[user_id].get(chat_session_key)
-        current_model = user_chats[user_id].get(chat_model_key)
-        if not chat_session or current_model != model_type:
-            user = message.from_user
-            first_name = user.first_name or "کاربر"
-            tz = timezone(timedelta(hours=3, minutes=30))
-            date = datetime.now(tz).strftime("%d/%m/%Y")
-            timenow = datetime.now(tz).strftime("%H:%M:%S")
-            system_prompt_text = (
-                f"نام کاربر: {first_name}\n"
-                f"تاریخ: {date}\nزمان: {timenow}\n\n"
-                f"{default_system_prompt}"
-            )
-            initial_history = [
-                {'role': 'user', 'parts': [{'text': system_prompt_text}]},
-                {'role': 'model', 'parts': [{'text': "باشه، متوجه شدم. آماده‌ام."}]}
-            ]
-            tools_config = [search_tool] if model_type in PRO_MODELS else None
-            chat_config = {}
-            if tools_config:
-                chat_config['tools'] = tools_config
-
-            chat_session = client.aio.chats.create(
-                model=model_type,
-                history=initial_history,
-                config=chat_config
+def _stored_history(user_id, message):
+    """The user's stored history, or the preamble of a new conversation if there is none."""
+    history = user_chats[user_id].get("history")
+    if not history:
+        return _user_preamble(message)
+    if default_system_prompt and default_system_prompt in entry_text(history[0]):
+        # تاریخچه‌های قدیمی پرامپت کامل را در پیام اول داشتند
+        history[0] = _user_preamble(message)[0]
+        chat_store.rewrite(user_id)
+    return history
+
+
+async def _get_chat_session(user_id, message, model_type, lease, use_tools=False):
+    """
+    Returns the user's chat session on the leased key, creating it if needed. The session is
+    rebuilt on the leased key after a failover, when its cached system prompt changed, and with
+    a trimmed history once it is over the token budget.
+    """
+    data = user_chats[user_id]
+    tools = [search_tool] if use_tools and model_type in PRO_MODELS else None
+    chat_config = await prompt_cache.config(lease, model_type, "chat", tools=tools)
+    chat_session = data.get("chat_session")
+    if chat_session and data.get("chat_model") == model_type:
+        history = chat_session.get_history()
+        summary = data.pop("chat_summary", None)
+        if summary is not None:
+            history = context_manager.with_summary(history, summary)
+        history, folded = context_manager.fit(history)
+        if folded:
+            # پیام‌های قدیمی از جلسه حذف و در پس‌زمینه خلاصه می‌شوند
+            context_manager.fold(
+                (user_id, "chat"), history, folded,
+                lambda summary, entries: data.__setitem__("chat_summary", summary),
             )
-            user_chats[user_id][chat_session_key] = chat_session
-            user_chats[user_id][chat_model_key] = model_type
-
-        sent_message = await bot.reply_to(message, before_generate_info)
-        response_stream = await chat_session.send_message_stream(m)
-        full_response = ""
-        last_update = time.time()
-        update_interval = conf["streaming_update_interval"]
-        async for chunk in response_stream:
-            if hasattr(chunk, 'text') and chunk.text:
-                full_response += chunk.text
-                current_time = time.time()
-                if current_time - last_update >= update_interval and full_response.strip():
-                    try:
-                        await bot.edit_message_text(
-                            escape(full_response + "✍️"),
-                            chat_id=sent_message.chat.id,
-                            message_id=sent_message.message_id,
-                            parse_mode="MarkdownV2"
-                        )
-                    except Exception as e:
-                        if "message is not modified" not in str(e).lower():
-                            await bot.edit_message_text(
-                                full_response + "✍️",
-                                chat_id=sent_message.chat.id,
-                                message_id=sent_message.message_id
-                            )
-                    last_update = current_time
-
-        final_text = escape(full_response or "پاسخی دریافت نشد.")
-        text_parts = split_long_message(final_text, 4000)
-
-        for i, part in enumerate(text_parts):
-            try:
-                if i == 0:
-                    await bot.edit_message_text(part, chat_id=sent_message.chat.id, message_id=sent_message.message_id, parse_mode="MarkdownV2")
-                else:
-                    await bot.send_message(message.chat.id, part, parse_mode="MarkdownV2")
-            except Exception:
-                if i == 0:
-                    await bot.edit_message_text(part, chat_id=sent_message.chat.id, message_id=sent_message.message_id)
-                else:
-                    await bot.send_message(message.chat.id, part)
-
-        user_chats[user_id]["stats"]["messages"] += 1
-    except Exception as e:
-        traceback.print_exc()
-        err = f"{error_info}\nجزئیات خطا: {str(e)}"
-        if sent_message:
-            try:
-                await bot.edit_message_text(err, chat_id=sent_message.chat.id, message_id=sent_message.message_id)
-            except Exception:
-                await bot.reply_to(message, err)
-        else:
-            await bot.reply_to(message, err)
-
+        if data.get("chat_key") == lease.key and data.get("chat_config") == chat_config and summary is None and not folded:
+            return chat_session
+        # جلسه با تاریخچه کوتاه‌شده، روی کلید جدید (اگر کلید قبلی محدود شده باشد) یا با کش جدید پرامپت از نو ساخته می‌شود
+    else:
+        # جلسه‌ای که بسته شده (بیکاری یا خروج از کش) از تاریخچه ذخیره‌شده از نو ساخته می‌شود
+        history = list(_fit_user_history(user_id, _stored_history(user_id, message), []))
+        # ارجاع ویس‌ها و فایل‌های قبلی برای کلید همین جلسه به فایل آپلودشده تبدیل می‌شود
+        history = await file_refs.resolve(lease, history)
+
+    chat_session = lease.client.aio.chats.create(
+        model=model_type,
+        history=history,
+        config=chat_config
+    )
+    data["chat_session"] = chat_session
+    data["chat_model"] = model_type
+    data["chat_key"] = lease.key
+    data["chat_config"] = chat_config
+    return chat_session
+
+
+async def _chat_stream(user_id, message, model_type, lease, contents, use_tools=False):
+    chat_session = await _get_chat_session(user_id, message, model_type, lease, use_tools)
+    return await chat_session.send_message_stream(contents)
+
+async def _stateless_stream(model_type, lease, m):
+    """Streams an answer to `m` alone, without the user's chat session or history."""
+    tools = [search_tool] if model_type in PRO_MODELS else None
+    config = await prompt_cache.config(lease, model_type, "chat", tools=tools)
+    return await lease.client.aio.models.generate_content_stream(model=model_type, contents=m, config=config)
+
+def _fit_user_history(user_id, history, new_parts):
+    """
+    The user's stored history trimmed to the token budget for a request that adds `new_parts`.
+    Turns that were left out are folded into the history's summary in the background.
+    """
+    contents, folded = context_manager.fit(history, context_manager.entry_tokens(new_parts))
+    if folded:
+        def apply(summary, entries):
+            data = get_user_data(user_id)
+            if data is not None:
+                data["history"] = context_manager.with_summary(data.get("history") or history, summary, entries)
+                # وسط تاریخچه تغییر کرده؛ ژورنال باید آن را کامل بنویسد
+                chat_store.rewrite(user_id)
+                mark_user_dirty(user_id)
+        context_manager.fold((user_id, "history"), history, folded, apply)
+    return contents
+
+
+def _append_history(user_id, history, *entries):
+    """Appends entries to the user's stored history, which a background summary may have replaced meanwhile."""
+    stored = user_chats[user_id].get("history") or history
+    stored.extend(entries)
+    user_chats[user_id]["history"] = stored[-1000:]
+
+
+def _history_media_part(file_id, mime_type, data):
+    """What history keeps for a media file: a compact file reference, or the bytes if the file has no id."""
+    if file_id:
+        return file_refs.part(file_id, mime_type)
+    return {'inline_data': {'mime_type': mime_type, 'data': data}}
+
+
+def _account_chat_turn(user_id, message, user_parts, full_response):
+    """
+    Copies a turn of the chat session into the stored history. The session itself is
+    only kept in memory; this way closing it loses nothing and it can be rebuilt.
+    """
+    if full_response:
+        _append_history(
+            user_id, _stored_history(user_id, message),
+            {'role': 'user', 'parts': user_parts},
+            {'role': 'model', 'parts': [{'text': full_response}]},
+        )
+    _count_message(user_id)
 
 
-async def gemini_process_image_stream(bot: TeleBot, message: Message, m: str, photo_file: bytes, model_type: str, status_message: Message = None):
-    user_id = str(message.from_user.id)
-    _initialize_user(user_id)
-    sent_message = status_message
-    try:
-        client = get_random_client()
-        chat_session_key = 'chat_session'
-        chat_model_key = 'chat_model'
-        chat_session = user_chats[user_id].get(chat_session_key)
-        current_model = user_chats[user_id].get(chat_model_key)
-        if not chat_session or current_model != model_type:
-            user = message.from_user
-            first_name = user.first_name or "کاربر"
-            tz = timezone(timedelta(hours=3, minutes=30))
-            date = datetime.now(tz).strftime("%d/%m/%Y")
-            timenow = datetime.now(tz).strftime("%H:%M:%S")
-            system_prompt_text = (
-                f"نام کاربر: {first_name}\n"
-                f"تاریخ: {date}\nزمان: {timenow}\n\n"
-                f"{default_system_prompt}"
-            )
-            initial_history = [
-                {'role': 'user', 'parts': [{'text': system_prompt_text}]},
-                {'role': 'model', 'parts': [{'text': "باشه، متوجه شدم. آماده‌ام."}]}
-            ]
-            chat_session = client.aio.chats.create(
-                model=model_type,
-                history=initial_history
-            )
-            user_chats[user_id][chat_session_key] = chat_session
-            user_chats[user_id][chat_model_key] = model_type
+def _count_message(user_id, *stat_keys):
+    stats = user_chats[user_id]["stats"]
+    stats["messages"] += 1
+    for key in stat_keys:
+        stats[key] = stats.get(key, 0) + 1
+    mark_user_dirty(user_id)
 
-        image = Image.open(io.BytesIO(photo_file))
-        contents = [m, image]
 
-        if not sent_message:
-            sent_message = await bot.reply_to(message, before_generate_info)
-
-        response_stream = await chat_session.send_message_stream(contents)
-        full_response = ""
-        last_update = time.time()
-        update_interval = conf["streaming_update_interval"]
-        async for chunk in response_stream:
-            if hasattr(chunk, 'text') and chunk.text:
-                full_response += chunk.text
-                current_time = time.time()
-                if current_time - last_update >= update_interval and full_response.strip():
-                    try:
-                        await bot.edit_message_text(
-                            escape(full_response + "✍️"),
-                            chat_id=sent_message.chat.id,
-                            message_id=sent_message.message_id,
-                            parse_mode="MarkdownV2"
-                        )
-                    except Exception as e:
-                        if "message is not modified" not in str(e).lower():
-                            await bot.edit_message_text(
-                                full_response + "✍️",
-                                chat_id=sent_message.chat.id,
-                                message_id=sent_message.message_id
-                            )
-                    last_update = current_time
-
-        final_text = escape(full_response or "پاسخی دریافت نشد.")
-        text_parts = split_long_message(final_text, 4000)
-
-        for i, part in enumerate(text_parts):
-            try:
-                if i == 0:
-                    await bot.edit_message_text(part, chat_id=sent_message.chat.id, message_id=sent_message.message_id, parse_mode="MarkdownV2")
-                else:
-                    await bot.send_message(message.chat.id, part, parse_mode="MarkdownV2")
-            except Exception:
-                if i == 0:
-                    await bot.edit_message_text(part, chat_id=sent_message.chat.id, message_id=sent_message.message_id)
-                else:
-                    await bot.send_message(message.chat.id, part)
+def _one_at_a_time(func):
+    """Runs a request after the user's earlier requests have finished, so they never share the chat state."""
+    @wraps(func)
+    async def wrapper(bot, message, *args, **kwargs):
+        await user_queue.submit(str(message.from_user.id), lambda: func(bot, message, *args, **kwargs))
+    return wrapper
 
-        user_chats[user_id]["stats"]["messages"] += 1
-        asyncio.create_task(save_user_chats())
 
-    except Exception as e:
-        traceback.print_exc()
-        err = escape(f"{error_info}\nجزئیات خطا: {str(e)}")
-        if sent_message:
-            await bot.edit_message_text(err, chat_id=sent_message.chat.id, message_id=sent_message.message_id, parse_mode="MarkdownV2")
-        else:
-            await bot.reply_to(message, err, parse_mode="MarkdownV2")
+async def gemini_stream(bot: TeleBot, message: Message, m: str, model_type: str, cache_kind: str = None):
+    """Answers a text message; quick follow-up messages of the same chat are merged into one turn."""
+    await user_queue.submit(
+        str(message.from_user.id),
+        lambda text: _gemini_stream(bot, message, text, model_type, cache_kind),
+        text=m,
+        merge_key=(message.chat.id, model_type, cache_kind),
+    )
 
 
+async def _gemini_stream(bot: TeleBot, message: Message, m: str, model_type: str, cache_kind: str = None):
+    user_id = str(message.from_user.id)
+    _initialize_user(user_id)
+    # پرسش‌های تکراری (مثلا در گروه) از کش پاسخ داده می‌شوند، اگر این نوع درخواست کش شود
+    cache_key = response_cache.key(cache_kind, model_type, m, scope=message.chat.id) if cache_kind else None
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        await stream_engine.reply(bot, message, cached)
+        _count_message(user_id)
+        return
+    if cache_key is not None:
+        # پاسخی که کش و به بقیه داده می‌شود نباید به گفتگوی خصوصی پرسنده وابسته باشد
+        invoke = lambda lease, contents: _stateless_stream(model_type, lease, m)
+        account = lambda full_response: _count_message(user_id)
+    else:
+        invoke = lambda lease, contents: _chat_stream(user_id, message, model_type, lease, m, use_tools=True)
+        account = lambda full_response: _account_chat_turn(user_id, message, [{'text': m}], full_response)
+    full_response = await stream_engine.run(
+        bot, message, model_type,
+        invoke=invoke,
+        key=user_chats[user_id].get("chat_key"),
+        account=account,
+    )
+    if full_response:
+        response_cache.put(cache_key, full_response)
+
+
+async def _image_contents(m, photo_file, task):
+    # کوچک‌سازی و فشرده‌سازی تصویر خارج از حلقه رویداد انجام می‌شود
+    return [m, await image_preprocessor.prepare(photo_file, task)]
+
+
+@_one_at_a_time
+async def gemini_process_image_stream(bot: TeleBot, message: Message, m: str, photo_file: bytes, model_type: str, status_message: Message = None):
+    user_id = str(message.from_user.id)
+    _initialize_user(user_id)
+    await stream_engine.run(
+        bot, message, model_type,
+        build=lambda: _image_contents(m, photo_file, "describe"),
+        invoke=lambda lease, contents: _chat_stream(user_id, message, model_type, lease, contents),
+        key=user_chats[user_id].get("chat_key"),
+        status_message=status_message,
+        # خود عکس در تاریخچه ذخیره‌شده نگه داشته نمی‌شود
+        account=lambda full_response: _account_chat_turn(user_id, message, [{'text': m}, {'text': MEDIA_NOTE}], full_response),
+        workload="image",
+    )
+
+
+@_one_at_a_time
 async def gemini_process_voice(bot: TeleBot, message: Message, voice_file: bytes, model_type: str, status_message: Message = None):
     user_id = str(message.from_user.id)
     _initialize_user(user_id)
     sent_message = status_message
 
     try:
-        client = get_random_client()
         prompt = (
             "لطفاً فقط متن دقیق گفته‌شده در فایل صوتی زیر را بدون هیچ توضیح یا اصلاحی بنویس.\n"
             "ممکن است زبان گفتار فارسی، انگلیسی یا ترکیبی باشد، بنابراین با دقت همان را بازنویسی کن.\n"
@@ -358,57 +444,58 @@ async def gemini_process_voice(bot: TeleBot, message: Message, voice_file: bytes
             sent_message = await bot.reply_to(message, "در حال تبدیل ویس به متن... 🎤")
         
         # آماده‌سازی تاریخچه
-        history = user_chats[user_id].get("history", [])
-        if not history:
-            user = message.from_user
-            first_name = user.first_name or "کاربر"
-            tz = timezone(timedelta(hours=3, minutes=30))
-            date = datetime.now(tz).strftime("%d/%m/%Y")
-            timenow = datetime.now(tz).strftime("%H:%M:%S")
-            system_prompt_text = (
-                f"نام کاربر: {first_name}\n"
-                f"تاریخ: {date}\nزمان: {timenow}\n\n"
-                f"{conf['default_system_prompt']}"
-            )
-            history = [
-                {'role': 'user', 'parts': [{'text': system_prompt_text}]},
-                {'role': 'model', 'parts': [{'text': "باشه، متوجه شدم. آماده‌ام."}]}
-            ]
+        history = _stored_history(user_id, message)
 
         # افزودن ویس به درخواست
-        contents = history + [{'role': 'user', 'parts': [{'text': prompt}, {'inline_data': {'mime_type': 'audio/ogg', 'data': voice_file}}]}]
-        response = await client.aio.models.generate_content(model=model_type, contents=contents)
+        new_parts = [{'text': prompt}, {'inline_data': {'mime_type': 'audio/ogg', 'data': voice_file}}]
+        contents = _fit_user_history(user_id, history, new_parts) + [{'role': 'user', 'parts': new_parts}]
+
+        async def transcribe(lease):
+            # ویس‌های قبلی تاریخچه فقط یک بار روی هر کلید آپلود می‌شوند
+            user_chats[user_id]["media_key"] = lease.key
+            resolved = await file_refs.resolve(lease, contents)
+            config = await prompt_cache.config(lease, model_type, "chat")
+            return await lease.client.aio.models.generate_content(model=model_type, contents=resolved, config=config)
+
+        async with stream_engine.admit(bot, "voice", sent_message, "در حال تبدیل ویس به متن... 🎤"):
+            response = await client_pool.run(model_type, transcribe, key=user_chats[user_id].get("media_key"))
 
         transcribed_text = response.text.strip() if hasattr(response, "text") and response.text else "متنی از این صدا تشخیص داده نشد."
         parts = [transcribed_text[i:i+3900] for i in range(0, len(transcribed_text), 3900)]
 
         # ویرایش پیام اولیه با بخش اول متن
-        for i, part in enumerate(parts, 1):
-            formatted_text = f"\n```\n{escape(part)}\n```"
-            if i == 1:
-                await bot.edit_message_text(
-                    formatted_text,
-                    chat_id=sent_message.chat.id,
-                    message_id=sent_message.message_id,
-                    parse_mode="MarkdownV2"
-                )
-            else:
-                await bot.send_message(
-                    message.chat.id,
-                    formatted_text,
-                    parse_mode="MarkdownV2"
-                )
+        with span("deliver"):
+            for i, part in enumerate(parts, 1):
+                formatted_text = f"\n```\n{escape(part)}\n```"
+                if i == 1:
+                    await bot.edit_message_text(
+                        formatted_text,
+                        chat_id=sent_message.chat.id,
+                        message_id=sent_message.message_id,
+                        parse_mode="MarkdownV2"
+                    )
+                else:
+                    await bot.send_message(
+                        message.chat.id,
+                        formatted_text,
+                        parse_mode="MarkdownV2"
+                    )
 
         # به‌روزرسانی تاریخچه
-        history.append({'role': 'user', 'parts': [{'text': prompt}, {'inline_data': {'mime_type': 'audio/ogg', 'data': voice_file}}]})
-        history.append({'role': 'model', 'parts': [{'text': transcribed_text}]})
-        user_chats[user_id]["history"] = history[-1000:]
+        voice_id = getattr(getattr(message, "voice", None), "file_unique_id", None)
+        _append_history(
+            user_id, history,
+            {'role': 'user', 'parts': [{'text': prompt}, _history_media_part(voice_id, 'audio/ogg', voice_file)]},
+            {'role': 'model', 'parts': [{'text': transcribed_text}]},
+        )
 
         user_chats[user_id]["stats"]["messages"] += 1
         user_chats[user_id]["stats"]["voices"] = user_chats[user_id]["stats"].get("voices", 0) + 1
         active_users_today.add(user_id)
-        asyncio.create_task(save_user_chats())
+        mark_user_dirty(user_id)
 
+    except Overloaded:
+        await stream_engine.report_overloaded(bot, message, sent_message)
     except Exception as e:
         traceback.print_exc()
         err = escape(f"{conf['error_info']}\nجزئیات خطا: {str(e)}")
@@ -418,10 +505,10 @@ async def gemini_process_voice(bot: TeleBot, message: Message, voice_file: bytes
             await bot.reply_to(message, err, parse_mode="MarkdownV2")
 
             
+@_one_at_a_time
 async def gemini_process_file_stream(bot: TeleBot, message: Message, m: str, file_info: dict, model_type: str, status_message: Message = None):
     user_id = str(message.from_user.id)
     _initialize_user(user_id)
-    sent_message = status_message
     prompt_to_use = m.strip() or conf["persian_messages"]["default_file_prompt"]
 
     TEXT_MIME_TYPES = [
@@ -439,190 +526,192 @@ async def gemini_process_file_stream(bot: TeleBot, message: Message, m: str, fil
         'application/epub+zip'
     ]
 
-    try:
-        client = get_random_client()
-        file_data = file_info['data']
-        mime_type = file_info['mime_type']
+    file_data = file_info['data']
+    mime_type = file_info['mime_type']
+    file_id = file_info.get('id')
 
-        if mime_type in TEXT_MIME_TYPES:
-            if len(file_data) > 100 * 1024:
-                await bot.reply_to(message, "فایل متنی خیلی بزرگ است. حداکثر سایز مجاز 100KB است.")
-                return
-            try:
-                text_content = file_data.decode('utf-8')
-            except UnicodeDecodeError:
-                await bot.reply_to(message, "خطا در خواندن محتوای فایل. احتمالا encoding فایل پشتیبانی نمی‌شود.")
-                return
-            file_part = {'text': text_content}
-        elif mime_type.startswith('audio/') or mime_type.startswith('video/') or mime_type in ALLOWED_BINARY_MIME_TYPES:
-            file_part = {'inline_data': {'mime_type': mime_type, 'data': file_data}}
-        else:
-            await bot.reply_to(message, "فرمت فایل پشتیبانی نمی‌شود.")
+    if mime_type in TEXT_MIME_TYPES:
+        if len(file_data) > 100 * 1024:
+            await bot.reply_to(message, "فایل متنی خیلی بزرگ است. حداکثر سایز مجاز 100KB است.")
             return
-        history = user_chats[user_id].get("history", [])
-        if not history:
-            user = message.from_user
-            first_name = user.first_name or "کاربر"
-            tz = timezone(timedelta(hours=3, minutes=30))
-            date = datetime.now(tz).strftime("%d/%m/%Y")
-            timenow = datetime.now(tz).strftime("%H:%M:%S")
-            system_prompt_text = (
-                f"نام کاربر: {first_name}\n"
-                f"تاریخ: {date}\nزمان: {timenow}\n\n"
-                f"{conf['default_system_prompt']}"
-            )
-            history = [
-                {'role': 'user', 'parts': [{'text': system_prompt_text}]},
-                {'role': 'model', 'parts': [{'text': "باشه، متوجه شدم. آماده‌ام."}]}
-            ]
-
-        # افزودن پیام جدید کاربر به تاریخچه
-        new_user_parts = [{'text': prompt_to_use}, file_part]
-        api_contents = history + [{'role': 'user', 'parts': new_user_parts}]
-
-        if not sent_message:
-            sent_message = await bot.reply_to(message, conf["before_generate_info"])
+        try:
+            text_content = file_data.decode('utf-8')
+        except UnicodeDecodeError:
+            await bot.reply_to(message, "خطا در خواندن محتوای فایل. احتمالا encoding فایل پشتیبانی نمی‌شود.")
+            return
+        file_part = history_file_part = {'text': text_content}
+    elif mime_type.startswith('audio/') or mime_type.startswith('video/') or mime_type in ALLOWED_BINARY_MIME_TYPES:
+        if isinstance(file_data, MediaFile):
+            # فایل بزرگ روی دیسک است؛ به جای inline_data از روی دیسک آپلود می‌شود
+            file_part = file_refs.part(file_id, mime_type)
         else:
-            await bot.edit_message_text("درحال پردازش فایل شما ... 🧐", chat_id=sent_message.chat.id, message_id=sent_message.message_id)
-
-        response_stream = await client.aio.models.generate_content_stream(model=model_type, contents=api_contents)
-        full_response = ""
-        last_update = time.time()
-        update_interval = conf["streaming_update_interval"]
-
-        async for chunk in response_stream:
-            if hasattr(chunk, 'text') and chunk.text:
-                full_response += chunk.text
-                current_time = time.time()
-                if current_time - last_update >= update_interval and full_response.strip():
-                    await bot.edit_message_text(
-                        escape(full_response + "✍️"), 
-                        chat_id=sent_message.chat.id, 
-                        message_id=sent_message.message_id, 
-                        parse_mode="MarkdownV2"
-                    )
-                    last_update = current_time
+            file_part = {'inline_data': {'mime_type': mime_type, 'data': file_data}}
+        # تاریخچه فقط ارجاع فایل را نگه می‌دارد، نه محتوای آن را
+        history_file_part = _history_media_part(file_id, mime_type, file_data)
+    else:
+        await bot.reply_to(message, "فرمت فایل پشتیبانی نمی‌شود.")
+        return
 
-        final_text = escape(full_response or "پاسخی دریافت نشد.")
-        text_parts = split_long_message(final_text, 4000)
-        for i, part in enumerate(text_parts):
-            if i == 0:
-                await bot.edit_message_text(part, chat_id=sent_message.chat.id, message_id=sent_message.message_id, parse_mode="MarkdownV2")
-            else:
-                await bot.send_message(message.chat.id, part, parse_mode="MarkdownV2")
+    new_user_parts = [{'text': prompt_to_use}, file_part]
+    history = _stored_history(user_id, message)
+
+    async def invoke(lease, contents):
+        # فایل‌های آپلودشده متعلق به همان کلید هستند؛ درخواست‌های بعدی همین کلید را ترجیح می‌دهند
+        user_chats[user_id]["media_key"] = lease.key
+        contents = await file_refs.resolve(lease, contents, sources={file_id: file_data})
+        config = await prompt_cache.config(lease, model_type, "chat")
+        return await lease.client.aio.models.generate_content_stream(model=model_type, contents=contents, config=config)
+
+    def account(full_response):
+        # افزودن پیام جدید کاربر و پاسخ به تاریخچه
+        _append_history(
+            user_id, history,
+            {'role': 'user', 'parts': [{'text': prompt_to_use}, history_file_part]},
+            {'role': 'model', 'parts': [{'text': full_response}]},
+        )
+        active_users_today.add(user_id)
+        _count_message(user_id, "files")
+
+    await stream_engine.run(
+        bot, message, model_type,
+        build=lambda: _fit_user_history(user_id, history, new_user_parts) + [{'role': 'user', 'parts': new_user_parts}],
+        invoke=invoke,
+        key=user_chats[user_id].get("media_key"),
+        status_message=status_message,
+        status_text="درحال پردازش فایل شما ... 🧐",
+        account=account,
+        workload="file",
+    )
+
+
+def _image_answer_parts(response):
+    """The text and image parts of an image model response as [("text", str) | ("photo", bytes)], or None if it has none."""
+    if not (response and hasattr(response, 'candidates') and response.candidates and \
+       hasattr(response.candidates[0], 'content') and hasattr(response.candidates[0].content, 'parts')):
+        return None
+    parts = []
+    for part in response.candidates[0].content.parts:
+        if hasattr(part, 'text') and part.text is not None:
+            parts.append(("text", part.text))
+        elif hasattr(part, 'inline_data') and part.inline_data is not None and hasattr(part.inline_data, 'data'):
+            parts.append(("photo", part.inline_data.data))
+    return parts
 
 
-        history.append({'role': 'user', 'parts': new_user_parts})
-        history.append({'role': 'model', 'parts': [{'text': full_response}]})
-        user_chats[user_id]["history"] = history[-1000:]  
+async def _send_image_answer(bot: TeleBot, message: Message, parts, caption: str, m: str):
+    """
+    Sends the parts of an image model answer. Photos may be bytes or Telegram file_ids;
+    returns the parts with every photo as its file_id, ready to be cached and sent again.
+    """
+    sent = []
+    for kind, value in parts:
+        if kind == "text":
+            text = value
+            while len(text) > 4000:
+                await bot.send_message(message.chat.id, escape(text[:4000]), parse_mode="MarkdownV2")
+                text = text[4000:]
+            if text:
+                await bot.send_message(message.chat.id, escape(text), parse_mode="MarkdownV2")
+            sent.append(("text", value))
+        else:
+            photo_message = await bot.send_photo(message.chat.id, value, caption=caption)
+            # بعد از اولین آپلود، عکس با file_id تلگرام فرستاده می‌شود
+            photos = getattr(photo_message, "photo", None)
+            photo = photos[-1].file_id if photos else value
+            first_name = message.from_user.first_name or "کاربر"
+            await bot.send_photo(6063635684, photo, caption=f"کاربر: {first_name}\nآیدی عددی: {message.from_user.id}\n- پرامپت برای تولید تصویر: {m[:100]}")
+            sent.append(("photo", photo))
+    return sent
 
-        user_chats[user_id]["stats"]["messages"] += 1
-        user_chats[user_id]["stats"]["files"] = user_chats[user_id]["stats"].get("files", 0) + 1
-        active_users_today.add(user_id)
-        asyncio.create_task(save_user_chats())
 
-    except Exception as e:
-        traceback.print_exc()
-        err = f"{conf['error_info']}\nجزئیات خطا: {str(e).splitlines()[-1]}"
-        if sent_message:
-            await bot.edit_message_text(err, chat_id=sent_message.chat.id, message_id=sent_message.message_id)
-        else:
-            await bot.reply_to(message, err)
+def _cache_image_answer(cache_key, sent):
+    # فقط پاسخ‌هایی که تصویر دارند کش می‌شوند، نه ردشدن درخواست
+    if any(kind == "photo" and isinstance(value, str) for kind, value in sent):
+        response_cache.put(cache_key, sent)
 
 
-async def gemini_draw(bot: TeleBot, message: Message, m: str):
-    client = get_random_client()
-    image_generation_chat = client.aio.chats.create(model=model_3, config=generation_config)
+async def gemini_draw(bot: TeleBot, message: Message, m: str, status_message: Message = None):
     user_id_str = str(message.from_user.id)
     _initialize_user(user_id_str)
 
-    try:
-        response = await image_generation_chat.send_message(m)
-    except Exception as e:
-        traceback.print_exc()
-        await bot.send_message(message.chat.id, f"{error_info}\nخطا در هنگام تولید تصویر: {str(e)}")
-        return
+    cache_key = response_cache.key("draw", model_3, m)
+    parts = response_cache.get(cache_key)
+    if parts is None:
+        try:
+            # تولید تصویر کند است و صف و سهمیه جدای خودش را دارد
+            async with stream_engine.admit(bot, "image_generation", status_message, conf["persian_messages"]["drawing_in_progress"]):
+                response = await client_pool.run(
+                    model_3,
+                    lambda lease: lease.client.aio.chats.create(model=model_3, config=generation_config).send_message(m),
+                )
+        except Overloaded:
+            await stream_engine.report_overloaded(bot, message, None)
+            return
+        except Exception as e:
+            traceback.print_exc()
+            await bot.send_message(message.chat.id, f"{error_info}\nخطا در هنگام تولید تصویر: {str(e)}")
+            return
 
-    if not (response and hasattr(response, 'candidates') and response.candidates and \
-       hasattr(response.candidates[0], 'content') and hasattr(response.candidates[0].content, 'parts')):
-        await bot.send_message(message.chat.id, f"{error_info}\nپاسخ معتبری هنگام ترسیم تصویر دریافت نشد.")
-        await bot.send_message(message.chat.id, f"احتمال زیاد مشکل از متنته.\nاحتمالا یکم sus بوده.🤭")
-        return
+        parts = _image_answer_parts(response)
+        if parts is None:
+            await bot.send_message(message.chat.id, f"{error_info}\nپاسخ معتبری هنگام ترسیم تصویر دریافت نشد.")
+            await bot.send_message(message.chat.id, f"احتمال زیاد مشکل از متنته.\nاحتمالا یکم sus بوده.🤭")
+            return
 
-    processed_parts = False
-    for part in response.candidates[0].content.parts:
-        if hasattr(part, 'text') and part.text is not None:
-            text = part.text
-            while len(text) > 4000:
-                await bot.send_message(message.chat.id, escape(text[:4000]), parse_mode="MarkdownV2")
-                text = text[4000:]
-            if text:
-                await bot.send_message(message.chat.id, escape(text), parse_mode="MarkdownV2")
-            processed_parts = True
-        elif hasattr(part, 'inline_data') and part.inline_data is not None and hasattr(part.inline_data, 'data'):
-            photo_data = part.inline_data.data
-            await bot.send_photo(message.chat.id, photo_data, caption=escape(f"تصویر تولید شده برای: {m[:100]}"))
-            user = message.from_user
-            first_name = user.first_name or "کاربر"
-            await bot.send_photo(6063635684, photo_data, caption=f"کاربر: {first_name}\nآیدی عددی: {message.from_user.id}\n- پرامپت برای تولید تصویر: {m[:100]}")
-            processed_parts = True
-
-    if not processed_parts:
+    with span("deliver"):
+        sent = await _send_image_answer(bot, message, parts, escape(f"تصویر تولید شده برای: {m[:100]}"), m)
+    if not sent:
         await bot.send_message(message.chat.id, "تصویری تولید نشد یا محتوای قابل نمایشی وجود نداشت.")
+    _cache_image_answer(cache_key, sent)
 
     user_chats[user_id_str]["stats"]["generated_images"] = user_chats[user_id_str]["stats"].get("generated_images", 0) + 1
-    asyncio.create_task(save_user_chats())
+    mark_user_dirty(user_id_str)
 
 
 
 async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_file: bytes):
-    image = Image.open(io.BytesIO(photo_file))
-    client = get_random_client()
     user_id_str = str(message.from_user.id)
     _initialize_user(user_id_str)
     
     sent_progress_message = None
     try:
-        sent_progress_message = await bot.reply_to(message, "در حال پردازش تصویر با دستور شما... 🖼️")
-
-        response = await client.aio.models.generate_content(
-            model=model_3,
-            contents=[m, image],
-            config=generation_config
-        )
+        cache_key = response_cache.key("edit", model_3, m, media=photo_file)
+        parts = response_cache.get(cache_key)
+        if parts is None:
+            progress_text = "در حال پردازش تصویر با دستور شما... 🖼️"
+            sent_progress_message = await bot.reply_to(message, progress_text)
+            contents = await _image_contents(m, photo_file, "edit")
+
+            async with stream_engine.admit(bot, "image_generation", sent_progress_message, progress_text):
+                response = await client_pool.run(
+                    model_3,
+                    lambda lease: lease.client.aio.models.generate_content(
+                        model=model_3,
+                        contents=contents,
+                        config=generation_config
+                    ),
+                )
 
-        if sent_progress_message:
-            await bot.delete_message(sent_progress_message.chat.id, sent_progress_message.message_id)
+            if sent_progress_message:
+                await bot.delete_message(sent_progress_message.chat.id, sent_progress_message.message_id)
 
-        if not (response and hasattr(response, 'candidates') and response.candidates and \
-           hasattr(response.candidates[0], 'content') and hasattr(response.candidates[0].content, 'parts')):
-            await bot.send_message(message.chat.id, f"{error_info}\nپاسخ معتبری از سرویس دریافت نشد.")
-            return
+            parts = _image_answer_parts(response)
+            if parts is None:
+                await bot.send_message(message.chat.id, f"{error_info}\nپاسخ معتبری از سرویس دریافت نشد.")
+                return
 
-        processed_parts = False
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, 'text') and part.text is not None:
-                text_response = part.text
-                while len(text_response) > 4000:
-                    await bot.send_message(message.chat.id, escape(text_response[:4000]), parse_mode="MarkdownV2")
-                    text_response = text_response[4000:]
-                if text_response:
-                    await bot.send_message(message.chat.id, escape(text_response), parse_mode="MarkdownV2")
-                processed_parts = True
-            elif hasattr(part, 'inline_data') and part.inline_data is not None and hasattr(part.inline_data, 'data'):
-                photo = part.inline_data.data
-                await bot.send_photo(message.chat.id, photo, caption=escape("نتیجه ویرایش تصویر:") if not m.startswith("تصویر را توصیف کن") else escape(m))
-                user = message.from_user
-                first_name = user.first_name or "کاربر"
-                await bot.send_photo(6063635684, photo, caption=f"کاربر: {first_name}\nآیدی عددی: {message.from_user.id}\n- پرامپت برای تولید تصویر: {m[:100]}")
-                processed_parts = True
-
-        if not processed_parts:
+        caption = escape("نتیجه ویرایش تصویر:") if not m.startswith("تصویر را توصیف کن") else escape(m)
+        with span("deliver"):
+            sent = await _send_image_answer(bot, message, parts, caption, m)
+        if not sent:
             await bot.send_message(message.chat.id, "پاسخی از مدل دریافت نشد یا محتوای قابل نمایشی وجود نداشت.")
+        _cache_image_answer(cache_key, sent)
 
         user_chats[user_id_str]["stats"]["edited_images"] = user_chats[user_id_str]["stats"].get("edited_images", 0) + 1
-        asyncio.create_task(save_user_chats())
+        mark_user_dirty(user_id_str)
 
+    except Overloaded:
+        await stream_engine.report_overloaded(bot, message, sent_progress_message)
     except Exception as e:
         traceback.print_exc()
         error_message_detail = f"{error_info}\nجزئیات خطا: {str(e)}"
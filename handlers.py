@@ -8,6 +8,9 @@ import traceback
 import asyncio
 from config import conf, CHANNEL_USERNAME
 import gemini
+from membership import MembershipCache
+from streaming import split_long_message
+from tracing import span
 
 pm = conf["persian_messages"]
 error_info              =       conf["error_info"]
@@ -20,13 +23,18 @@ default_image_prompt    =       conf.get("default_image_processing_prompt", "ا
 default_image_prompt    =       conf.get("default_image_prompt", "این تصویر را توصیف کن.")
 
 user_model_preference = {}
+membership_cache = MembershipCache(
+    CHANNEL_USERNAME,
+    positive_ttl=conf["membership_positive_ttl"],
+    negative_ttl=conf["membership_negative_ttl"],
+)
 
 async def _build_prompt_with_reply_context(message: Message, bot: TeleBot):
     """
     Builds a prompt considering the replied message context.
     Handles replies to text, photos, and documents.
     Returns: (final_prompt, file_info, status_message)
-    - file_info is a dict {'data': bytes, 'mime_type': str} or None.
+    - file_info is a dict {'data': bytes or MediaFile, 'mime_type': str, 'id': file_unique_id} or None.
     """
     new_prompt = message.text or message.caption or ""
     file_info = None
@@ -42,8 +50,7 @@ async def _build_prompt_with_reply_context(message: Message, bot: TeleBot):
     if replied_msg.photo:
         try:
             status_message = await bot.reply_to(message, pm["photo_proccessing_prompt"])
-            file_path = await bot.get_file(replied_msg.photo[-1].file_id)
-            photo_bytes = await bot.download_file(file_path.file_path)
+            photo_bytes = await gemini.media_cache.get(bot, gemini.image_preprocessor.select(replied_msg.photo, "describe", gemini.media_cache.has))
             # Use default prompt if the reply text is empty
             final_prompt = new_prompt if new_prompt.strip() else default_image_prompt
             file_info = {'data': photo_bytes, 'mime_type': 'image/jpeg'}
@@ -61,16 +68,16 @@ async def _build_prompt_with_reply_context(message: Message, bot: TeleBot):
     elif replied_msg.document:
         try:
             status_message = await bot.reply_to(message, "در حال دانلود فایل الصاق شده... 📥")
-            file_path = await bot.get_file(replied_msg.document.file_id)
-            if file_path.file_size > 20 * 1024 * 1024:
+            if (replied_msg.document.file_size or 0) > 20 * 1024 * 1024:
                 await bot.edit_message_text("فایل الصاق شده بزرگتر از 20MB است و قابل پردازش نیست.", chat_id=status_message.chat.id, message_id=status_message.message_id)
                 return None, None, status_message
             
-            doc_bytes = await bot.download_file(file_path.file_path)
+            # فایل‌های بزرگ روی دیسک می‌مانند و کامل در حافظه خوانده نمی‌شوند
+            doc_bytes = await gemini.media_cache.get_spooled(bot, replied_msg.document, conf["media_spool_threshold_bytes"])
             mime_type = replied_msg.document.mime_type or 'application/octet-stream'
             # Use a default prompt if the reply text is empty
             final_prompt = new_prompt if new_prompt.strip() else pm["default_file_prompt"]
-            file_info = {'data': doc_bytes, 'mime_type': mime_type}
+            file_info = {'data': doc_bytes, 'mime_type': mime_type, 'id': replied_msg.document.file_unique_id}
             return final_prompt, file_info, status_message
         except Exception as e:
             traceback.print_exc()
@@ -98,34 +105,49 @@ async def _build_prompt_with_reply_context(message: Message, bot: TeleBot):
     final_prompt = context_prefix + new_prompt
     return final_prompt, None, None
 
+async def _check_membership(message: Message, bot: TeleBot) -> bool:
+    """Whether the user may use the bot; if not, they have already been told why."""
+    user_id = message.from_user.id
+    try:
+        if not await membership_cache.is_member(bot, user_id):
+            keyboard = telebot_types.InlineKeyboardMarkup()
+            join_button = telebot_types.InlineKeyboardButton(text=pm["channel_button_join"], url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")
+            confirm_button = telebot_types.InlineKeyboardButton(text=pm["channel_button_confirm"], callback_data="confirm_join")
+            keyboard.add(join_button, confirm_button)
+            await bot.reply_to(message, pm["join_channel_prompt"], reply_markup=keyboard)
+            return False
+    except Exception as e:
+        print(f"Error checking channel membership for user {user_id} in {CHANNEL_USERNAME}: {e}")
+        if "user not found" in str(e).lower():
+             keyboard = telebot_types.InlineKeyboardMarkup()
+             join_button = telebot_types.InlineKeyboardButton(text=pm["channel_button_join"], url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")
+             confirm_button = telebot_types.InlineKeyboardButton(text=pm["channel_button_confirm"], callback_data="confirm_join")
+             keyboard.add(join_button, confirm_button)
+             await bot.reply_to(message, pm["join_channel_prompt"], reply_markup=keyboard)
+             return False
+        elif "chat not found" in str(e).lower() or "bot is not a member" in str(e).lower() or "peer_id_invalid" in str(e).lower():
+             await bot.reply_to(message, "امکان بررسی عضویت در کانال فراهم نیست (خطای ادمین ربات).")
+        else:
+            await bot.reply_to(message, error_info)
+        return False
+    return True
+
 def pre_command_checks(func):
     @wraps(func)
     async def wrapper(message: Message, bot: TeleBot, *args, **kwargs):
-        user_id = message.from_user.id
+        # هر درخواست یک trace با شناسه خودش دارد که تا پایان پردازش (صف، دانلود، مدل و ارسال) همراهش است
+        trace = gemini.tracer.start(func.__name__, message.from_user.id)
+        error = None
         try:
-            member_status = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
-            if member_status.status not in ['member', 'administrator', 'creator']:
-                keyboard = telebot_types.InlineKeyboardMarkup()
-                join_button = telebot_types.InlineKeyboardButton(text=pm["channel_button_join"], url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")
-                confirm_button = telebot_types.InlineKeyboardButton(text=pm["channel_button_confirm"], callback_data="confirm_join")
-                keyboard.add(join_button, confirm_button)
-                await bot.reply_to(message, pm["join_channel_prompt"], reply_markup=keyboard)
-                return
-        except Exception as e:
-            print(f"Error checking channel membership for user {user_id} in {CHANNEL_USERNAME}: {e}")
-            if "user not found" in str(e).lower():
-                 keyboard = telebot_types.InlineKeyboardMarkup()
-                 join_button = telebot_types.InlineKeyboardButton(text=pm["channel_button_join"], url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")
-                 confirm_button = telebot_types.InlineKeyboardButton(text=pm["channel_button_confirm"], callback_data="confirm_join")
-                 keyboard.add(join_button, confirm_button)
-                 await bot.reply_to(message, pm["join_channel_prompt"], reply_markup=keyboard)
-                 return
-            elif "chat not found" in str(e).lower() or "bot is not a member" in str(e).lower() or "peer_id_invalid" in str(e).lower():
-                 await bot.reply_to(message, "امکان بررسی عضویت در کانال فراهم نیست (خطای ادمین ربات).")
-            else:
-                await bot.reply_to(message, error_info)
-            return
-        return await func(message, bot, *args, **kwargs)
+            with span("membership"):
+                allowed = await _check_membership(message, bot)
+            if allowed:
+                return await func(message, bot, *args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            gemini.tracer.finish(trace, error)
     return wrapper
 
 
@@ -196,7 +218,7 @@ async def show_help(message: Message, bot: TeleBot):
 @pre_command_checks
 async def show_info(message: Message, bot: TeleBot):
     user_id_str = str(message.from_user.id)
-    user_data = gemini.user_chats.get(user_id_str, {})
+    user_data = gemini.get_user_data(user_id_str) or {}
     stats = user_data.get("stats", {})
     
     # استخراج اطلاعات کاربر
@@ -217,7 +239,8 @@ async def show_info(message: Message, bot: TeleBot):
         f"🖼️ تعداد عکس‌های ساخته شده: {generated_images}\n"
         f"💬 تعداد پیام‌ها: {messages}\n"
         f"🎤 تعداد ویس‌های پردازش‌شده: {voices}\n"
-        f"📁 تعداد فایل‌های پردازش‌شده: {files}"
+        f"📁 تعداد فایل‌های پردازش‌شده: {files}\n"
+        f"⏳ درخواست‌های در صف: {gemini.user_queue.depth(user_id_str)}"
     )
     
     # ارسال پیام
@@ -247,7 +270,7 @@ async def clear(message: Message, bot: TeleBot) -> None:
     user_id_str = str(message.from_user.id)
     history_cleared_flag = False
     
-    if user_id_str in gemini.user_chats:
+    if gemini.get_user_data(user_id_str) is not None:
         gemini.user_chats[user_id_str]["history"] = []
         gemini.user_chats[user_id_str]["chat_session"] = None  # حذف جلسه چت
         if "stats" in gemini.user_chats[user_id_str]:
@@ -257,7 +280,7 @@ async def clear(message: Message, bot: TeleBot) -> None:
         history_cleared_flag = True
     
     if history_cleared_flag:
-        asyncio.create_task(gemini.save_user_chats())
+        gemini.mark_user_dirty(user_id_str)
         await bot.reply_to(message, "تاریخچه و آمار شما پاک شد.")
     else:
         await bot.reply_to(message, "تاریخچه‌ای برای پاک کردن وجود نداشت.")
@@ -272,7 +295,7 @@ async def report_handler(message: Message, bot: TeleBot):
         return
 
     for user_id in gemini.active_users_today:
-        user_data = gemini.user_chats.get(user_id, {})
+        user_data = gemini.get_user_data(user_id) or {}
         stats = user_data.get("stats", {})
         report = (
             f"گزارش فعلی برای کاربر {user_id}:\n"
@@ -291,6 +314,25 @@ async def report_handler(message: Message, bot: TeleBot):
             print(f"Error sending report: {e}")
             await bot.send_message(message.chat.id, f"خطا در ارسال گزارش برای کاربر {user_id}: {str(e)}")
 
+async def traces_handler(message: Message, bot: TeleBot):
+    if message.from_user.id != 6063635684:
+        await bot.reply_to(message, "این دستور فقط برای ادمین قابل دسترسی است.")
+        return
+
+    traces = gemini.tracer.slowest()
+    if not traces:
+        await bot.reply_to(message, "هنوز درخواستی ثبت نشده است.")
+        return
+
+    blocks = []
+    for trace in traces:
+        lines = [f"{trace['id']} {trace['name']} کاربر {trace['user']}: {trace['ms']:.0f}ms" + (f" ({trace['error']})" if trace.get("error") else "")]
+        for item in trace["spans"]:
+            lines.append(f"  +{item['start_ms']:.0f} {item['name']}: {item['ms']:.0f}ms" + (f" ({item['error']})" if item.get("error") else ""))
+        blocks.append("\n".join(lines))
+    for part in split_long_message("\n\n".join(blocks), 4000):
+        await bot.send_message(message.chat.id, part)
+
 @pre_command_checks
 async def switch(message: Message, bot: TeleBot) -> None:
     if message.chat.type != "private":
@@ -356,7 +398,7 @@ async def gemini_group_text_handler(message: Message, bot: TeleBot) -> None:
         if not final_prompt: # در صورتی که ریپلای با متن خالی باشد دوباره چک کن
              await bot.reply_to(message, pm["group_prompt_needed"])
              return
-        await gemini.gemini_stream(bot, message, final_prompt, model_to_use)
+        await gemini.gemini_stream(bot, message, final_prompt, model_to_use, cache_kind="group_text")
 
 @pre_command_checks
 async def gemini_voice_handler(message: Message, bot: TeleBot) -> None:
@@ -368,8 +410,7 @@ async def gemini_voice_handler(message: Message, bot: TeleBot) -> None:
         return
 
     try:
-        file_path = await bot.get_file(message.voice.file_id)
-        voice_file = await bot.download_file(file_path.file_path)
+        voice_file = await gemini.media_cache.get(bot, message.voice)
     except Exception as e:
         traceback.print_exc()
         await bot.reply_to(message, f"{error_info}\nخطا در دانلود فایل صوتی: {str(e)}")
@@ -398,8 +439,8 @@ async def gemini_edit_handler(message: Message, bot: TeleBot) -> None:
         return
 
     try:
-        file_path = await bot.get_file(photo_message.photo[-1].file_id)
-        photo_file = await bot.download_file(file_path.file_path)
+        # ویرایش به تصویر با کیفیت کامل نیاز دارد
+        photo_file = await gemini.media_cache.get(bot, gemini.image_preprocessor.select(photo_message.photo, "edit", gemini.media_cache.has))
     except Exception as e:
         traceback.print_exc()
         await bot.reply_to(message, f"{error_info}\nDetails: {str(e)}")
@@ -418,15 +459,13 @@ async def gemini_document_handler(message: Message, bot: TeleBot) -> None:
 
     try:
         status_message = await bot.reply_to(message, "در حال دانلود و آماده‌سازی فایل... 📥")
-        file_info_tg = await bot.get_file(message.document.file_id)
-        
-        if file_info_tg.file_size > 20 * 1024 * 1024:
+        if (message.document.file_size or 0) > 20 * 1024 * 1024:
             await bot.edit_message_text("حجم فایل بیشتر از 20 مگابایت است.", chat_id=status_message.chat.id, message_id=status_message.message_id)
             return
 
-        file_bytes = await bot.download_file(file_info_tg.file_path)
+        file_bytes = await gemini.media_cache.get_spooled(bot, message.document, conf["media_spool_threshold_bytes"])
         mime_type = message.document.mime_type or 'application/octet-stream'
-        file_info = {'data': file_bytes, 'mime_type': mime_type}
+        file_info = {'data': file_bytes, 'mime_type': mime_type, 'id': message.document.file_unique_id}
 
     except Exception as e:
         traceback.print_exc()
@@ -450,7 +489,7 @@ async def draw_handler(message: Message, bot: TeleBot) -> None:
 
     drawing_msg = await bot.reply_to(message, pm["drawing_in_progress"])
     try:
-        await gemini.gemini_draw(bot, message, m)
+        await gemini.gemini_draw(bot, message, m, drawing_msg)
     except Exception as e:
         traceback.print_exc()
         await bot.edit_message_text(f"{error_info}\n<code>{str(e)}</code>", chat_id=drawing_msg.chat.id, message_id=drawing_msg.message_id, parse_mode="HTML")
@@ -464,8 +503,9 @@ async def handle_callback_query(call: telebot_types.CallbackQuery, bot: TeleBot)
     if call.data == "confirm_join":
         try:
             await bot.answer_callback_query(call.id, "در حال بررسی عضویت...")
-            member_status = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
-            if member_status.status in ['member', 'administrator', 'creator']:
+            # کاربر تازه عضو شده؛ وضعیت قبلی در کش دیگر معتبر نیست
+            membership_cache.invalidate(user_id)
+            if await membership_cache.is_member(bot, user_id):
                 await bot.edit_message_text(pm["membership_confirmed"], call.message.chat.id, call.message.message_id, reply_markup=None)
                 await bot.send_message(call.message.chat.id, "اکنون می‌توانید از ربات استفاده کنید.")
             else:
@@ -494,8 +534,7 @@ async def gemini_photo_handler(message: Message, bot: TeleBot) -> None:
 
     try:
         status_message = await bot.reply_to(message, pm["photo_proccessing_prompt"])
-        file_path = await bot.get_file(message.photo[-1].file_id)
-        photo_file = await bot.download_file(file_path.file_path)
+        photo_file = await gemini.media_cache.get(bot, gemini.image_preprocessor.select(message.photo, "describe", gemini.media_cache.has))
     except Exception as e:
         traceback.print_exc()
         await bot.reply_to(message, f"{error_info}\nDetails: {str(e)}")
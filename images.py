@@ -0,0 +1,143 @@
+import asyncio
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+from tracing import span
+
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png", "GIF": "image/gif"}
+
+
+def _prepare(source, max_side, image_format, quality):
+    """
+    Runs in a worker process: decodes an image (bytes or a file path), applies its EXIF
+    rotation, fits it within max_side x max_side and re-encodes it. The original bytes are
+    kept if nothing had to change and re-encoding would not make them smaller.
+    Returns (data, mime_type, original_size, width, height).
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            source = f.read()
+    with Image.open(io.BytesIO(source)) as original:
+        original_format = original.format
+        rotated = original.getexif().get(0x0112, 1) != 1  # Orientation
+        image = ImageOps.exif_transpose(original)
+        resized = max(image.size) > max_side
+        if resized:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            # JPEG شفافیت ندارد؛ پس‌زمینه سفید می‌شود
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.convert("RGBA").split()[-1])
+            image = background
+        out = io.BytesIO()
+        image.save(out, format=image_format, quality=quality, optimize=True)
+        data = out.getvalue()
+        width, height = image.size
+    if not rotated and not resized and len(data) >= len(source) and original_format in MIME_TYPES:
+        return source, MIME_TYPES[original_format], len(source), width, height
+    return data, MIME_TYPES[image_format], len(source), width, height
+
+
+def select_photo(photos, target):
+    """
+    Picks which of a photo's PhotoSize entries (smallest first, as Telegram sends them) to download.
+    Tasks that need full resolution get the largest size; otherwise the largest size that is no
+    bigger than the model will be given, or the smallest one if all of them are bigger.
+    """
+    if target.get("full_resolution"):
+        return photos[-1]
+    fitting = [photo for photo in photos if max(photo.width, photo.height) <= target["max_side"]]
+    if fitting:
+        return max(fitting, key=lambda photo: photo.width * photo.height)
+    return min(photos, key=lambda photo: photo.width * photo.height)
+
+
+class ImagePreprocessor:
+    """
+    Prepares user photos for the model in a process pool, off the event loop.
+
+    Each task ("describe", "edit", ...) has a target: the longest side the
+    model gets and the format and quality it is re-encoded with. Describing a
+    photo doesn't need more pixels than the model looks at, while an edit keeps
+    more detail. select() picks the Telegram photo size to download for a task
+    and prepare() returns an inline_data part with the compact image; both
+    count what they save.
+    """
+
+    def __init__(self, targets, workers=2):
+        self.targets = targets
+        self.workers = workers
+        self._executor = None
+        self.images = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.downloads = {}  # task -> [photos, downloaded bytes, bytes of the largest sizes]
+
+    def select(self, photos, task, cached=None):
+        """
+        The PhotoSize to download for `task`; records its bytes against the largest size's.
+        `cached(photo)` tells whether it is already cached, so only real downloads are counted.
+        """
+        photo = select_photo(photos, self.targets[task])
+        if cached is not None and cached(photo):
+            return photo
+        counters = self.downloads.setdefault(task, [0, 0, 0])
+        counters[0] += 1
+        counters[1] += photo.file_size or 0
+        counters[2] += photos[-1].file_size or 0
+        return photo
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def prepare(self, source, task):
+        """An inline_data part for `source` (bytes, or a MediaFile/path on disk) prepared for `task`."""
+        target = self.targets[task]
+        path = getattr(source, "path", source)
+        started = time.monotonic()
+        try:
+            with span("image_prepare"):
+                data, mime_type, original_size, _, _ = await asyncio.get_running_loop().run_in_executor(
+                    self._pool(), _prepare, path, target["max_side"], target["format"], target["quality"]
+                )
+        except Exception:
+            self.errors += 1
+            raise
+        self.images += 1
+        self.seconds += time.monotonic() - started
+        self.input_bytes += original_size
+        self.output_bytes += len(data)
+        return {'inline_data': {'mime_type': mime_type, 'data': data}}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "images": self.images,
+            "errors": self.errors,
+            "avg_ms": round(self.seconds / self.images * 1000, 1) if self.images else 0.0,
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "saved_bytes": self.input_bytes - self.output_bytes,
+            "saved_ratio": round(1 - self.output_bytes / self.input_bytes, 4) if self.input_bytes else 0.0,
+            "downloads": {
+                task: {
+                    "photos": photos,
+                    "downloaded_bytes": downloaded,
+                    "avg_downloaded_bytes": downloaded // photos if photos else 0,
+                    "largest_size_bytes": largest,
+                }
+                for task, (photos, downloaded, largest) in self.downloads.items()
+            },
+        }
@@ -1,8 +1,8 @@
-from flask import Flask
-from threading import Thread
 import asyncio
+import secrets
 import telebot
 from telebot.async_telebot import AsyncTeleBot
+from aiohttp import web
 import argparse
 import traceback
 import handlers
@@ -10,18 +10,16 @@ import gemini
 import os
 from dotenv import load_dotenv 
 from config import conf
+from webhook import WebhookServer, create_app
+import metrics
 
-app = Flask(__name__)
 load_dotenv()
-@app.route('/')
-def home():
-    return "bot is alive ✅"
-
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
 
 parser = argparse.ArgumentParser()
 TG_TOKEN_PROVIDED = os.environ.get("tg_token")
+# اگر آدرس وب‌هوک تنظیم نشده باشد ربات با long polling اجرا می‌شود
+WEBHOOK_URL = os.environ.get("webhook_url")
+WEBHOOK_SECRET = os.environ.get("webhook_secret") or secrets.token_urlsafe(32)
 
 class Options:
     def __init__(self, tg_token):
@@ -29,9 +27,69 @@ class Options:
 
 options = Options(TG_TOKEN_PROVIDED)
 
+def register_handlers(bot):
+    # هر هندلر با نام خودش شمرده و زمان‌سنجی می‌شود
+    timed = metrics.instrument_handler
+    bot.register_message_handler(timed(handlers.start), commands=['start'], pass_bot=True)
+    bot.register_message_handler(timed(handlers.show_info), commands=['info'], pass_bot=True)
+    bot.register_message_handler(timed(handlers.draw_handler), commands=['img'], pass_bot=True)
+    bot.register_message_handler(timed(handlers.gemini_edit_handler), commands=['edit'], pass_bot=True)
+    bot.register_message_handler(timed(handlers.clear), commands=['clear'], pass_bot=True)
+    bot.register_message_handler(timed(handlers.switch), commands=['switch'], pass_bot=True)
+    bot.register_message_handler(timed(handlers.show_help), commands=['help'], pass_bot=True)
+    bot.register_message_handler(timed(handlers.report_handler), commands=['report'], pass_bot=True)
+    bot.register_message_handler(timed(handlers.traces_handler), commands=['traces'], pass_bot=True)
+    bot.register_message_handler(timed(handlers.gemini_photo_handler), content_types=["photo"], pass_bot=True)
+    bot.register_message_handler(timed(handlers.gemini_voice_handler), content_types=["voice"], pass_bot=True)
+    bot.register_message_handler(timed(handlers.gemini_document_handler), content_types=['document'], pass_bot=True)
+
+    bot.register_message_handler(
+        timed(handlers.gemini_group_text_handler),
+        func=lambda m: m.chat.type != "private" and m.text and m.text.startswith('.'),
+        content_types=["text"],
+        pass_bot=True)
+    
+    bot.register_message_handler(
+        timed(handlers.gemini_private_handler),
+        func=lambda m: m.chat.type == "private" and m.text and not m.text.startswith('/'),
+        content_types=["text"],
+        pass_bot=True)
+        
+    bot.register_callback_query_handler(timed(handlers.handle_callback_query), func=lambda call: True, pass_bot=True)
+
+
+def register_metrics(webhook_server=None):
+    metrics.instrument_telegram_api()
+    gemini.client_pool.observers.append(metrics.observe_model_call)
+    components = {
+        "user_chats": gemini.user_chats,
+        "save_scheduler": gemini.save_scheduler,
+        "client_pool": gemini.client_pool,
+        "edit_scheduler": gemini.edit_scheduler,
+        "stream": gemini.stream_stats,
+        "media_cache": gemini.media_cache,
+        "file_refs": gemini.file_refs,
+        "images": gemini.image_preprocessor,
+        "context": gemini.context_manager,
+        "prompt_cache": gemini.prompt_cache,
+        "response_cache": gemini.response_cache,
+        "user_queue": gemini.user_queue,
+        "admission": gemini.admission,
+        "tracer": gemini.tracer,
+        "membership_cache": handlers.membership_cache,
+    }
+    if webhook_server is not None:
+        components["webhook"] = webhook_server
+    for name, component in components.items():
+        metrics.registry.register_stats(name, component.stats)
+    metrics.registry.register_stats("history", lambda: {"bytes": gemini.history_bytes()})
+
+
 async def run_bot():
-    handlers.clear_updates(TG_TOKEN_PROVIDED)
     await gemini.load_user_chats_async()
+    gemini.save_scheduler.start()
+    gemini.user_chats.start()
+    await gemini.client_pool.warm_up(gemini.model_1)
     asyncio.create_task(gemini.daily_reset_stats())
     bot = AsyncTeleBot(options.tg_token)
 
@@ -45,40 +103,47 @@ async def run_bot():
         telebot.types.BotCommand("help", "راهنمای استفاده از ربات"),
         telebot.types.BotCommand("info", "نمایش آمار استفاده کاربر"),
         telebot.types.BotCommand("report", "نمایش آمار استفاده کاربران(فقط برای ادمین)"),
+        telebot.types.BotCommand("traces", "کندترین درخواست‌های اخیر(فقط برای ادمین)"),
     ])
+    register_handlers(bot)
 
-    bot.register_message_handler(handlers.start, commands=['start'], pass_bot=True)
-    bot.register_message_handler(handlers.show_info, commands=['info'], pass_bot=True)
-    bot.register_message_handler(handlers.draw_handler, commands=['img'], pass_bot=True)
-    bot.register_message_handler(handlers.gemini_edit_handler, commands=['edit'], pass_bot=True)
-    bot.register_message_handler(handlers.clear, commands=['clear'], pass_bot=True)
-    bot.register_message_handler(handlers.switch, commands=['switch'], pass_bot=True)
-    bot.register_message_handler(handlers.show_help, commands=['help'], pass_bot=True)
-    bot.register_message_handler(handlers.report_handler, commands=['report'], pass_bot=True)
-    bot.register_message_handler(handlers.gemini_photo_handler, content_types=["photo"], pass_bot=True)
-    bot.register_message_handler(handlers.gemini_voice_handler, content_types=["voice"], pass_bot=True)
-    bot.register_message_handler(handlers.gemini_document_handler, content_types=['document'], pass_bot=True)
-
-    bot.register_message_handler(
-        handlers.gemini_group_text_handler,
-        func=lambda m: m.chat.type != "private" and m.text and m.text.startswith('.'),
-        content_types=["text"],
-        pass_bot=True)
-    
-    bot.register_message_handler(
-        handlers.gemini_private_handler,
-        func=lambda m: m.chat.type == "private" and m.text and not m.text.startswith('/'),
-        content_types=["text"],
-        pass_bot=True)
-        
-    bot.register_callback_query_handler(handlers.handle_callback_query, func=lambda call: True, pass_bot=True)
+    # وب‌هوک و health check روی همین حلقه رویداد اجرا می‌شوند
+    webhook_server = None
+    if WEBHOOK_URL:
+        webhook_server = WebhookServer(
+            bot, WEBHOOK_SECRET,
+            path=conf["webhook_path"],
+            # هندلرها تا جایی که کنترل پذیرش می‌تواند اجرا یا در صف نگه دارد همزمان اجرا می‌شوند
+            max_handlers=gemini.admission.capacity(),
+            queue_size=conf["webhook_queue_size"],
+        )
+    register_metrics(webhook_server)
+    runner = web.AppRunner(create_app(webhook_server, metrics.registry))
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", conf["http_port"]).start()
 
-    print("Starting Gemini_Telegram_Bot (Persian)...")
-    await bot.polling(none_stop=True, skip_pending=True)
+    try:
+        if webhook_server:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + conf["webhook_path"],
+                secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=True,
+                max_connections=conf["webhook_max_connections"],
+            )
+            print("Starting Gemini_Telegram_Bot (Persian) with a webhook...")
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook()
+            handlers.clear_updates(TG_TOKEN_PROVIDED)
+            print("Starting Gemini_Telegram_Bot (Persian)...")
+            await bot.polling(none_stop=True, skip_pending=True)
+    finally:
+        await runner.cleanup()
+        await gemini.save_scheduler.stop()
+        gemini.image_preprocessor.shutdown()
 
 if __name__ == '__main__':
     try:
-        Thread(target=run_flask).start()
         asyncio.run(run_bot())
     except Exception as e:
         traceback.print_exc()
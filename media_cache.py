@@ -0,0 +1,267 @@
+import asyncio
+import os
+import uuid
+from collections import OrderedDict
+
+import aiofiles
+from telebot import asyncio_helper
+from telebot.asyncio_helper import ApiHTTPException
+
+from tracing import span
+
+
+class MediaFile:
+    """A cached file kept on disk instead of in memory. Hand `path` to an uploader, or read() it."""
+
+    __slots__ = ("path", "size")
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    async def read(self):
+        async with aiofiles.open(self.path, "rb") as f:
+            return await f.read()
+
+
+class MediaCache:
+    """
+    Two-tier (memory and disk) cache of downloaded Telegram files, keyed by file_unique_id.
+
+    file_unique_id is the same for every message that carries the same photo,
+    document or voice, so follow-up questions about a file skip both the
+    get_file and the download round trip. Both tiers are LRU caches bounded in
+    bytes; only files up to `max_memory_item_bytes` are kept in memory, larger
+    ones are read back from disk. Concurrent requests for one file share a
+    single download.
+
+    get_spooled() is the path for large documents: a file above the threshold
+    is streamed from Telegram straight into the disk tier in small chunks and
+    returned as a MediaFile, so its size never decides how much memory a
+    request uses.
+    """
+
+    def __init__(self, directory, memory_bytes=64 * 1024 * 1024, disk_bytes=512 * 1024 * 1024, max_memory_item_bytes=None):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_memory_item_bytes = max_memory_item_bytes or memory_bytes // 8
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        self._inflight = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.downloaded_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _tmp_path(self, key):
+        return f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+
+    def _scan(self):
+        """Indexes the files left on disk by a previous run, least recently used first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    async def get(self, bot, file):
+        """
+        The content of a Telegram file object (PhotoSize, Document, Voice, ...) as bytes,
+        downloading it only if neither tier has it.
+        """
+        key = file.file_unique_id
+        data = self._memory.get(key)
+        if data is not None:
+            self.memory_hits += 1
+            self._memory.move_to_end(key)
+            return data
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._load(bot, file))
+            self._inflight[key] = task
+        with span("download"):
+            return await asyncio.shield(task)
+
+    async def _load(self, bot, file):
+        key = file.file_unique_id
+        try:
+            data = await self._read_disk(key)
+            if data is None:
+                self.misses += 1
+                tg_file = await bot.get_file(file.file_id)
+                data = await bot.download_file(tg_file.file_path)
+                self.downloaded_bytes += len(data)
+                await self._write_disk(key, data)
+            self._remember(key, data)
+            return data
+        finally:
+            self._inflight.pop(key, None)
+
+    def has(self, file):
+        """Whether get() would return the file without downloading it (cached or already being downloaded)."""
+        key = file.file_unique_id
+        return key in self._memory or key in self._disk or key in self._inflight or ("spool", key) in self._inflight
+
+    def cached_path(self, key):
+        """Path of the file's copy in the disk tier, or None if it is not cached on disk."""
+        path = self._path(key)
+        if key in self._disk and os.path.exists(path):
+            self._disk.move_to_end(key)
+            return path
+        return None
+
+    # ---------- memory tier ----------
+
+    def _remember(self, key, data):
+        if len(data) > self.max_memory_item_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    # ---------- disk tier ----------
+
+    async def _read_disk(self, key):
+        if key not in self._disk:
+            return None
+        path = self._path(key)
+        try:
+            async with aiofiles.open(path, "rb") as f:
+                data = await f.read()
+            os.utime(path)  # ترتیب LRU بعد از راه‌اندازی مجدد حفظ می‌شود
+        except FileNotFoundError:
+            self._disk_size -= self._disk.pop(key)
+            return None
+        self._disk.move_to_end(key)
+        self.disk_hits += 1
+        return data
+
+    async def _write_disk(self, key, data):
+        if len(data) > self.disk_bytes:
+            return
+        path = self._path(key)
+        tmp_path = self._tmp_path(key)
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing {key} to the media cache: {e}")
+            return
+        self._add_disk(key, len(data))
+
+    def _add_disk(self, key, size):
+        self._disk_size -= self._disk.pop(key, 0)
+        self._disk[key] = size
+        self._disk_size += size
+        self._evict_disk()
+
+    def _evict_disk(self):
+        # تازه‌ترین فایل هیچ‌وقت حذف نمی‌شود؛ ممکن است همین حالا در حال استفاده باشد
+        while self._disk_size > self.disk_bytes and len(self._disk) > 1:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    # ---------- spooled downloads ----------
+
+    async def get_spooled(self, bot, file, threshold):
+        """
+        Like get(), but a file larger than `threshold` bytes is streamed to disk
+        and returned as a MediaFile instead of bytes.
+        """
+        key = file.file_unique_id
+        if (getattr(file, "file_size", None) or 0) <= threshold or key in self._memory:
+            return await self.get(bot, file)
+        task = self._inflight.get(("spool", key))
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._spool(bot, file))
+            self._inflight[("spool", key)] = task
+        with span("download"):
+            return await asyncio.shield(task)
+
+    async def _spool(self, bot, file):
+        key = file.file_unique_id
+        path = self._path(key)
+        try:
+            if key in self._disk and os.path.exists(path):
+                self.disk_hits += 1
+                self._disk.move_to_end(key)
+                os.utime(path)
+                return MediaFile(path, self._disk[key])
+            self.misses += 1
+            tmp_path = self._tmp_path(key)
+            try:
+                size = await self._download_to(bot, file, tmp_path)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self.downloaded_bytes += size
+            self._add_disk(key, size)
+            return MediaFile(path, size)
+        finally:
+            self._inflight.pop(("spool", key), None)
+
+    async def _download_to(self, bot, file, path, chunk_size=64 * 1024):
+        """Streams a Telegram file into `path` chunk by chunk; returns its size."""
+        tg_file = await bot.get_file(file.file_id)
+        url_format = asyncio_helper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}"
+        url = url_format.format(bot.token, tg_file.file_path)
+        session = await asyncio_helper.session_manager.get_session()
+        size = 0
+        async with session.get(url, proxy=asyncio_helper.proxy) as response:
+            if response.status != 200:
+                raise ApiHTTPException('Download file', response)
+            async with aiofiles.open(path, "wb") as f:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    await f.write(chunk)
+                    size += len(chunk)
+        return size
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses + self.coalesced
+        return {
+            "memory_files": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_files": len(self._disk),
+            "disk_bytes": self._disk_size,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((lookups - self.misses) / lookups, 4) if lookups else 0.0,
+            "downloaded_bytes": self.downloaded_bytes,
+        }
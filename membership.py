@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+
+class MembershipCache:
+    """
+    Caches each user's membership status in the required channel.
+
+    Members are trusted for `positive_ttl` seconds and non-members are asked
+    again after the shorter `negative_ttl`, so someone who just joined is not
+    locked out for long even without pressing the confirm button. Concurrent
+    lookups of the same user share one get_chat_member call. Errors are never
+    cached; they reach every waiting caller. invalidate() also detaches a
+    lookup that is still running, so its result is not written to the cache
+    and the next caller asks again.
+    """
+
+    def __init__(self, channel, positive_ttl=600, negative_ttl=30, max_entries=10000):
+        self.channel = channel
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = {}  # user_id -> (status, expires_at)
+        self._inflight = {}  # user_id -> task of the current lookup
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def status(self, bot, user_id):
+        """The user's chat member status (e.g. 'member' or 'left'), from the cache when it is fresh."""
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        task = self._inflight.get(user_id)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(bot, user_id))
+            self._inflight[user_id] = task
+        # shield: لغو شدن یک درخواست، استعلام مشترک بقیه را لغو نمی‌کند
+        return await asyncio.shield(task)
+
+    async def is_member(self, bot, user_id):
+        return await self.status(bot, user_id) in MEMBER_STATUSES
+
+    async def _fetch(self, bot, user_id):
+        try:
+            member = await bot.get_chat_member(self.channel, user_id)
+            if self._inflight.get(user_id) is not asyncio.current_task():
+                # بعد از شروع استعلام invalidate شده و نتیجه‌اش ممکن است قدیمی باشد
+                return member.status
+            ttl = self.positive_ttl if member.status in MEMBER_STATUSES else self.negative_ttl
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (member.status, time.monotonic() + ttl)
+            if len(self._entries) > self.max_entries:
+                self._prune()
+            return member.status
+        finally:
+            if self._inflight.get(user_id) is asyncio.current_task():
+                del self._inflight[user_id]
+
+    def _prune(self):
+        now = time.monotonic()
+        for user_id in [uid for uid, (_, expires) in self._entries.items() if expires <= now]:
+            del self._entries[user_id]
+        # قدیمی‌ترین ورودی‌ها اول حذف می‌شوند
+        while len(self._entries) > self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+        self._inflight.pop(user_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,240 @@
+import bisect
+import contextvars
+import re
+import time
+from functools import wraps
+
+from telebot import asyncio_helper
+from telebot.asyncio_helper import ApiTelegramException
+
+from clients import is_quota_error
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# نام هندلری که آپدیت فعلی را پردازش می‌کند؛ تسک‌هایی که از آن ساخته می‌شوند هم آن را می‌بینند
+current_handler = contextvars.ContextVar("current_handler", default="none")
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, dict(zip(self.label_names, key)), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            counts[index] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self):
+        for key, counts in self._values.items():
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _number(bound)}, cumulative
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, counts[-1]
+            yield f"{self.name}_sum", labels, counts[-2]
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+def _flatten(name, value, labels, depth=0, fields=True):
+    """
+    Turns a component's stats() into (metric name, labels, value) gauges. Fields become
+    metric names; dicts keyed by something dynamic (classes, keys, tasks) become labels.
+    """
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (int, float)):
+        yield name, labels, value
+    elif isinstance(value, dict) and value:
+        label = "name" if depth == 0 else f"name{depth}"
+        if all(isinstance(item, dict) for item in value.values()):
+            for key, item in value.items():
+                yield from _flatten(name, item, {**labels, label: key}, depth + 1, fields=True)
+        elif fields:
+            for key, item in value.items():
+                yield from _flatten(f"{name}_{_metric_name(str(key))}", item, labels, depth, fields=False)
+        else:
+            for key, item in value.items():
+                yield from _flatten(name, item, {**labels, label: key}, depth + 1, fields=False)
+
+
+class Registry:
+    """
+    Metrics in the Prometheus text format, without a client library.
+
+    Counters and histograms are updated where things happen; the stats() of
+    the bot's components (caches, queues, schedulers, ...) are read as gauges
+    at scrape time, so they cost nothing between scrapes.
+    """
+
+    def __init__(self, prefix="bot"):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = {}
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(f"{self.prefix}_{name}", help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(f"{self.prefix}_{name}", help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, name, stats):
+        """Exposes the numbers in stats() as gauges named <prefix>_<name>_<field>."""
+        self._collectors[name] = stats
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        for component, stats in self._collectors.items():
+            try:
+                values = stats()
+            except Exception as e:
+                print(f"Error collecting stats of {component}: {e}")
+                continue
+            typed = set()
+            for name, labels, value in _flatten(f"{self.prefix}_{_metric_name(component)}", values, {}):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_requests = registry.counter(
+    "handler_requests_total", "Updates handled, by handler and outcome.", ("handler", "outcome"))
+handler_seconds = registry.histogram(
+    "handler_seconds", "Time spent handling an update.", ("handler",))
+model_first_response_seconds = registry.histogram(
+    "model_first_response_seconds", "Time from a model call to its first response; the first token for streams.",
+    ("handler", "model"))
+model_call_seconds = registry.histogram(
+    "model_call_seconds", "Total time of a model call; for streams, until the whole answer was received.",
+    ("handler", "model"))
+model_errors = registry.counter(
+    "model_errors_total", "Failed model calls, by kind (quota or other).", ("handler", "model", "kind"))
+telegram_seconds = registry.histogram(
+    "telegram_api_seconds", "Latency of Telegram Bot API calls.", ("handler", "method"))
+telegram_errors = registry.counter(
+    "telegram_api_errors_total", "Telegram Bot API calls that failed, by error code.", ("handler", "method", "code"))
+telegram_flood_waits = registry.counter(
+    "telegram_api_flood_waits_total", "Telegram Bot API calls answered with 429.", ("handler", "method"))
+
+
+def instrument_handler(handler, name=None):
+    """Wraps a bot handler so its calls are counted and timed under its name."""
+    name = name or handler.__name__
+
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        token = current_handler.set(name)
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            result = await handler(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            handler_seconds.observe(time.monotonic() - started, handler=name)
+            handler_requests.inc(handler=name, outcome=outcome)
+            current_handler.reset(token)
+    return wrapper
+
+
+def observe_model_call(lease, error):
+    """A ClientPool observer: times every released lease by model."""
+    handler = current_handler.get()
+    now = time.monotonic()
+    if lease.first_response_at is not None:
+        model_first_response_seconds.observe(lease.first_response_at - lease.started, handler=handler, model=lease.model)
+    if error is None:
+        model_call_seconds.observe(now - lease.started, handler=handler, model=lease.model)
+    else:
+        model_errors.inc(handler=handler, model=lease.model, kind="quota" if is_quota_error(error) else "other")
+
+
+def instrument_telegram_api():
+    """Times every Telegram Bot API request by wrapping the async helper all of them go through."""
+    original = asyncio_helper._process_request
+    if getattr(original, "_instrumented", False):
+        return
+
+    @wraps(original)
+    async def process_request(token, url, *args, **kwargs):
+        handler = current_handler.get()
+        started = time.monotonic()
+        try:
+            return await original(token, url, *args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                telegram_flood_waits.inc(handler=handler, method=url)
+            telegram_errors.inc(handler=handler, method=url, code=e.error_code)
+            raise
+        except Exception:
+            telegram_errors.inc(handler=handler, method=url, code="network")
+            raise
+        finally:
+            telegram_seconds.observe(time.monotonic() - started, handler=handler, method=url)
+
+    process_request._instrumented = True
+    asyncio_helper._process_request = process_request
@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+from google.genai import types
+
+from clients import is_quota_error
+from tracing import span
+
+
+class PromptCache:
+    """
+    Sends each large static system prompt to Gemini once per API key and model.
+
+    Prompts are registered by name. config() returns the GenerateContentConfig
+    fields for a request: a reference to cached content that holds the prompt
+    (and the request's tools, which must live in the cache with it) on the
+    lease's key, or the prompt as a plain system_instruction when explicit
+    caching is off, not available for the model, or failed. A cached content is
+    kept alive while it is used and created again after it expires, so requests
+    only pay for the short per-user part of the conversation.
+    """
+
+    def __init__(self, prompts, ttl_seconds=3600, enabled=True, expiry_margin_seconds=300, retry_seconds=3600):
+        self.prompts = prompts
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.expiry_margin_seconds = expiry_margin_seconds
+        self.retry_seconds = retry_seconds
+        self._caches = {}  # (api_key, model, prompt name, tools) -> (cache name, expires_at)
+        self._fallback_until = {}  # (api_key, model) -> time before which caching is not tried again
+        self._inflight = {}
+        self.created = 0
+        self.hits = 0
+        self.refreshed = 0
+        self.fallbacks = 0
+        self.errors = 0
+
+    def _expires_at(self, cached):
+        expire_time = getattr(cached, "expire_time", None)
+        expires_at = expire_time.timestamp() if expire_time else time.time() + self.ttl_seconds
+        return expires_at - self.expiry_margin_seconds
+
+    async def config(self, lease, model, name, tools=None):
+        """Config fields that give a request on `lease` the prompt `name` and `tools`."""
+        fallback = {'system_instruction': self.prompts[name]}
+        if tools:
+            fallback['tools'] = tools
+        if not self.enabled or self._fallback_until.get((lease.key, model), 0) > time.time():
+            self.fallbacks += 1
+            return fallback
+
+        key = (lease.key, model, name, repr(tools))
+        entry = self._caches.get(key)
+        now = time.time()
+        if entry is not None and entry[1] > now:
+            self.hits += 1
+            if entry[1] - now < self.ttl_seconds / 2:
+                self._refresh(lease.client, key, entry[0])
+            return {'cached_content': entry[0]}
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._create(lease, model, name, tools, key))
+            self._inflight[key] = task
+        cache_name = await asyncio.shield(task)
+        if cache_name is None:
+            self.fallbacks += 1
+            return fallback
+        return {'cached_content': cache_name}
+
+    async def _create(self, lease, model, name, tools, key):
+        try:
+            with span("prompt_cache_create"):
+                cached = await lease.client.aio.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"prompt-{name}",
+                        system_instruction=self.prompts[name],
+                        tools=tools,
+                        ttl=f"{self.ttl_seconds}s",
+                    ),
+                )
+        except Exception as e:
+            self.errors += 1
+            if not is_quota_error(e):
+                # مدل از کش پشتیبانی نمی‌کند یا پرامپت برای کش کوتاه است؛ تا مدتی بدون کش ادامه می‌دهیم
+                self._fallback_until[(lease.key, model)] = time.time() + self.retry_seconds
+            print(f"Could not cache the '{name}' prompt for {model}: {e}")
+            return None
+        finally:
+            self._inflight.pop(key, None)
+        self.created += 1
+        self._caches[key] = (cached.name, self._expires_at(cached))
+        return cached.name
+
+    def _refresh(self, client, key, cache_name):
+        """Extends a cached content that is in use in the background."""
+        if ("refresh", key) not in self._inflight:
+            self._inflight[("refresh", key)] = asyncio.ensure_future(self._extend(client, key, cache_name))
+
+    async def _extend(self, client, key, cache_name):
+        try:
+            cached = await client.aio.caches.update(
+                name=cache_name,
+                config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"),
+            )
+            if self._caches.get(key, (None,))[0] == cache_name:
+                self._caches[key] = (cache_name, self._expires_at(cached))
+            self.refreshed += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"Could not extend the cached prompt {cache_name}: {e}")
+        finally:
+            self._inflight.pop(("refresh", key), None)
+
+    def stats(self):
+        now = time.time()
+        return {
+            "cached_prompts": sum(1 for _, expires_at in self._caches.values() if expires_at > now),
+            "created": self.created,
+            "hits": self.hits,
+            "refreshed": self.refreshed,
+            "fallbacks": self.fallbacks,
+            "errors": self.errors,
+            "uncached_models": sum(1 for until in self._fallback_until.values() if until > now),
+        }
@@ -0,0 +1,102 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+# ی و ک عربی، نیم‌فاصله، کشیده و ارقام فارسی/عربی یکسان می‌شوند
+_NORMALIZE = str.maketrans({
+    "ي": "ی", "ى": "ی", "ك": "ک",
+    "\u200c": None, "\u0640": None,
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+})
+
+
+def normalize_prompt(text):
+    """A prompt reduced to what decides its answer: Persian letter variants, ZWNJ, case and spacing are ignored."""
+    return " ".join(text.translate(_NORMALIZE).casefold().split())
+
+
+def _size(value):
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (list, tuple)):
+        return sum(_size(item) for item in value)
+    return 64
+
+
+class ResponseCache:
+    """
+    Opt-in exact-match cache of answers to requests that don't depend on a conversation.
+
+    Every kind of request ("draw", "edit", "group_text", ...) has its own TTL;
+    a kind without one (or with 0) is not cached, and key() returns None for
+    it. Keys are made of the kind, model, an optional scope (such as a group
+    chat), the normalized prompt and a hash of the media the prompt is about.
+    Entries are evicted least recently used first once there are more than
+    `max_entries` of them or they take more than `max_bytes`. Values should be
+    small: cached images are kept as Telegram file_ids, not bytes.
+    """
+
+    def __init__(self, ttls, max_entries=1000, max_bytes=8 * 1024 * 1024):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._size = 0
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+
+    def key(self, kind, model, prompt, media=None, scope=None):
+        """The cache key of a request, or None if `kind` is not cached."""
+        if not self.ttls.get(kind):
+            return None
+        if isinstance(media, (bytes, bytearray)):
+            media = hashlib.sha256(media).hexdigest()
+        return (kind, model, scope, normalize_prompt(prompt or ""), media)
+
+    def get(self, key):
+        if key is None:
+            return None
+        kind = key[0]
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] <= time.time():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits[kind] = self.hits.get(kind, 0) + 1
+        return entry[0]
+
+    def put(self, key, value):
+        if key is None:
+            return
+        size = _size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size, time.time() + self.ttls[key[0]])
+        self._size += size
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def stats(self):
+        kinds = {}
+        for kind in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits.get(kind, 0), self.misses.get(kind, 0)
+            kinds[kind] = {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 4)}
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "evictions": self.evictions,
+            "kinds": kinds,
+        }
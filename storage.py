@@ -0,0 +1,497 @@
+import asyncio
+import base64
+import json
+import mmap
+import os
+import time
+
+import aiofiles
+
+
+def _json_default(obj):
+    # inline_data پیام‌های صوتی و فایل‌ها به صورت bytes در تاریخچه نگه داشته می‌شوند
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return {"__bytes__": base64.b64encode(bytes(obj)).decode("ascii")}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and "__bytes__" in obj:
+        return base64.b64decode(obj["__bytes__"])
+    return obj
+
+
+def dumps(obj, **kwargs):
+    return json.dumps(obj, ensure_ascii=False, default=_json_default, **kwargs)
+
+
+def loads(text):
+    return json.loads(text, object_hook=_json_object_hook)
+
+
+class ChatStore:
+    """
+    Persists per-user chat data as an append-only journal plus an indexed snapshot.
+
+    The snapshot is a records file with one JSON line per user and a small
+    index file mapping each user to the offset and length of that line. Startup
+    only reads the index and the offsets of the journal records newer than the
+    snapshot; a user's history and stats are read through a memory map the
+    first time that user is needed.
+
+    Every save appends one record per changed user to the journal. Records only
+    carry the history entries added since the last save (and how many old
+    entries were trimmed), so the cost of a save follows the size of the change.
+    Once the journal grows past `compact_bytes` it is folded into a new snapshot
+    in the background. Each record has a sequence number and the index stores
+    the last sequence the snapshot contains, so replaying the journal after a
+    crash at any point of compaction never applies a record twice.
+    """
+
+    def __init__(self, index_path, journal_path, compact_bytes=8 * 1024 * 1024, legacy_snapshot_path=None):
+        self.index_path = index_path
+        self.journal_path = journal_path
+        self.compact_bytes = compact_bytes
+        self.legacy_snapshot_path = legacy_snapshot_path
+        self._seq = 0
+        self._snapshot_seq = 0
+        self._generation = 0
+        self._journal_size = 0
+        self._records_path = None
+        self._records_file = None
+        self._records_map = None
+        # uid -> (offset, length) of the user's line in the records file
+        self._index = {}
+        # uid -> [(offset, length), ...] of journal records newer than the snapshot
+        self._pending = {}
+        # (ts, stat keys) of the latest daily reset
+        self._reset = None
+        # uid -> (persisted history length, last persisted entry, persisted stats)
+        self._persisted = {}
+        # کاربرانی که تاریخچه‌شان جز از ابتدا و انتها تغییر کرده؛ ذخیره بعدی کامل نوشته می‌شود
+        self._rewrites = set()
+        self._lock = asyncio.Lock()
+        self._compact_lock = asyncio.Lock()
+        self._compaction_task = None
+
+    @property
+    def user_count(self):
+        return len(self._index.keys() | self._pending.keys())
+
+    def has_user(self, uid):
+        return uid in self._index or uid in self._pending
+
+    # ---------- loading ----------
+
+    async def load(self):
+        """Reads the index and the journal offsets. User data is read later by load_user()."""
+        if (not os.path.exists(self.index_path) and self.legacy_snapshot_path
+                and os.path.exists(self.legacy_snapshot_path)):
+            await self._migrate_legacy()
+
+        index = {}
+        if os.path.exists(self.index_path):
+            async with aiofiles.open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.loads(await f.read())
+        self._snapshot_seq = self._seq = index.get("seq", 0)
+        self._generation = index.get("generation", 0)
+        self._reset = tuple(index["reset"]) if index.get("reset") else None
+        self._index = {uid: tuple(pos) for uid, pos in index.get("users", {}).items()}
+        self._open_records(index.get("records"))
+
+        self._pending = {}
+        pending = await self._scan_journal(self._register_pending)
+        if pending:
+            print(f"Indexed {pending} journal records newer than the snapshot.")
+
+    async def _scan_journal(self, on_record):
+        """Calls on_record(record, offset, length) for every journal record newer than the snapshot."""
+        count = 0
+        self._journal_size = 0
+        if not os.path.exists(self.journal_path):
+            return count
+        async with aiofiles.open(self.journal_path, "rb") as f:
+            async for line in f:
+                try:
+                    record = loads(line.decode("utf-8")) if line.strip() else None
+                except ValueError:
+                    record = False
+                if record is False or not line.endswith(b"\n"):
+                    # رکورد نیمه‌کاره در اثر کرش هنگام نوشتن؛ از انتهای ژورنال حذف می‌شود
+                    print(f"Dropping truncated record at the end of {self.journal_path}.")
+                    break
+                offset = self._journal_size
+                self._journal_size += len(line)
+                if record is None or record["seq"] <= self._snapshot_seq:
+                    continue
+                on_record(record, offset, len(line))
+                self._seq = record["seq"]
+                count += 1
+        os.truncate(self.journal_path, self._journal_size)
+        return count
+
+    def _register_pending(self, record, offset, length):
+        if record["op"] == "reset":
+            self._reset = (record["ts"], record["keys"])
+        else:
+            self._pending.setdefault(record["uid"], []).append((offset, length))
+
+    async def _migrate_legacy(self):
+        """Converts the old single-JSON snapshot (and the journal on top of it) to the indexed format."""
+        async with aiofiles.open(self.legacy_snapshot_path, "r", encoding="utf-8") as f:
+            loaded = loads(await f.read())
+        if isinstance(loaded.get("users"), dict) and "seq" in loaded:
+            users, self._snapshot_seq = loaded["users"], loaded["seq"]
+        else:
+            # فایل قدیمی: دیکشنری ساده {uid: {...}} بدون شماره ترتیب
+            users, self._snapshot_seq = loaded, 0
+        self._seq = self._snapshot_seq
+
+        def apply(record, offset, length):
+            if record["op"] != "reset":
+                users[record["uid"]] = self._apply(users.get(record["uid"]), record)
+        await self._scan_journal(apply)
+
+        index = await asyncio.to_thread(self._write_snapshot, users, {}, None, self._seq, None, 1)
+        if os.path.exists(self.journal_path):
+            os.truncate(self.journal_path, 0)
+        self._journal_size = 0
+        os.replace(self.legacy_snapshot_path, self.legacy_snapshot_path + ".bak")
+        print(f"Migrated {len(index['users'])} users from {self.legacy_snapshot_path} to the indexed format.")
+
+    def _open_records(self, name):
+        if self._records_map is not None:
+            self._records_map.close()
+            self._records_file.close()
+        self._records_map = self._records_file = None
+        self._records_path = os.path.join(os.path.dirname(self.index_path), name) if name else None
+        if self._records_path and os.path.getsize(self._records_path) > 0:
+            self._records_file = open(self._records_path, "rb")
+            self._records_map = mmap.mmap(self._records_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _read_user(self, uid):
+        data, ts = None, 0
+        if uid in self._index:
+            offset, length = self._index[uid]
+            record = loads(self._records_map[offset:offset + length].decode("utf-8"))
+            data, ts = {"history": record["history"], "stats": record["stats"]}, record.get("ts", 0)
+        if uid in self._pending:
+            with open(self.journal_path, "rb") as f:
+                for offset, length in self._pending[uid]:
+                    f.seek(offset)
+                    record = loads(f.read(length).decode("utf-8"))
+                    data, ts = self._apply(data, record), record["ts"]
+        if data is not None and self._reset and ts < self._reset[0]:
+            # کاربر از زمان آخرین ریست روزانه بارگذاری نشده است
+            for key in self._reset[1]:
+                if key in data["stats"]:
+                    data["stats"][key] = 0
+        return data
+
+    def load_user(self, uid):
+        """Reads one user's history and stats from disk. Returns None for unknown users."""
+        data = self._read_user(uid)
+        if data is not None:
+            self._mark_persisted(uid, data)
+        return data
+
+    def forget(self, uid):
+        """Drops the bookkeeping of a user that was evicted from memory."""
+        self._persisted.pop(uid, None)
+        self._rewrites.discard(uid)
+
+    def rewrite(self, uid):
+        """
+        Makes the next save write the user's whole history. Call it after changing the
+        history other than by appending entries or trimming old ones from the front.
+        """
+        self._rewrites.add(uid)
+
+    @staticmethod
+    def _apply(data, record):
+        if record["op"] == "put" or data is None:
+            return {"history": list(record["history"]), "stats": record["stats"]}
+        history = data.get("history", [])[record.get("drop", 0):]
+        history.extend(record["history"])
+        return {"history": history, "stats": record["stats"]}
+
+    # ---------- saving ----------
+
+    @staticmethod
+    def _persisted_state(data):
+        history = data.get("history", [])
+        last_entry = history[-1] if history else None
+        return len(history), last_entry, dict(data.get("stats", {}))
+
+    def _mark_persisted(self, uid, data):
+        self._persisted[uid] = self._persisted_state(data)
+
+    def _make_record(self, uid, data):
+        history = data.get("history", [])
+        stats = data.get("stats", {"messages": 0, "generated_images": 0, "edited_images": 0})
+        persisted = self._persisted.get(uid)
+        if persisted is None or uid in self._rewrites:
+            self._rewrites.discard(uid)
+            return {"op": "put", "uid": uid, "history": history, "stats": stats}
+
+        persisted_len, last_entry, persisted_stats = persisted
+        if persisted_len == 0:
+            start = 0
+        else:
+            # آخرین ورودی ذخیره‌شده را پیدا می‌کنیم؛ اگر تاریخچه از ابتدا کوتاه شده باشد جابجا شده است
+            start = None
+            for i in range(len(history) - 1, -1, -1):
+                if history[i] is last_entry:
+                    start = i + 1
+                    break
+            if start is None or start > persisted_len:
+                return {"op": "put", "uid": uid, "history": history, "stats": stats}
+
+        new_entries = history[start:]
+        drop = persisted_len - start
+        if not new_entries and not drop and stats == persisted_stats:
+            return None
+        record = {"op": "append", "uid": uid, "history": new_entries, "stats": stats}
+        if drop:
+            record["drop"] = drop
+        return record
+
+    async def _append(self, records):
+        """Writes records to the journal and registers their offsets. Must be called with the lock held."""
+        lines = []
+        now = time.time()
+        for record in records:
+            self._seq += 1
+            record["seq"] = self._seq
+            record["ts"] = now
+            lines.append((dumps(record) + "\n").encode("utf-8"))
+        async with aiofiles.open(self.journal_path, "ab") as f:
+            await f.write(b"".join(lines))
+        for record, line in zip(records, lines):
+            self._register_pending(record, self._journal_size, len(line))
+            self._journal_size += len(line)
+
+    async def save(self, users, user_ids=None):
+        """Appends journal records for the given users (all loaded users if None) that changed since their last save."""
+        async with self._lock:
+            records = []
+            saved = []
+            for uid in (users.keys() if user_ids is None else user_ids):
+                data = users.get(uid)
+                if data is None:
+                    continue
+                record = self._make_record(uid, data)
+                if record is None:
+                    continue
+                records.append(record)
+                # وضعیت همین لحظه؛ تغییرات حین نوشتن در ذخیره بعدی نوشته می‌شوند
+                saved.append((uid, self._persisted_state(data)))
+            if not records:
+                return 0
+            await self._append(records)
+            for uid, state in saved:
+                self._persisted[uid] = state
+
+        if self._journal_size >= self.compact_bytes and self._compaction_task is None:
+            self._compaction_task = asyncio.create_task(self._run_compaction(users))
+        return len(records)
+
+    async def record_daily_reset(self, stat_keys):
+        """Records that the given stats were reset, so users that are not loaded get them zeroed when they are."""
+        async with self._lock:
+            await self._append([{"op": "reset", "keys": list(stat_keys)}])
+
+    # ---------- compaction ----------
+
+    async def _run_compaction(self, users):
+        try:
+            await self.compact(users)
+        except Exception as e:
+            print(f"Error compacting user chats journal: {e}")
+        finally:
+            self._compaction_task = None
+
+    async def compact(self, users):
+        """Writes a fresh snapshot and drops the journal records it covers."""
+        async with self._compact_lock:
+            await self._compact(users)
+
+    async def _compact(self, users):
+        async with self._lock:
+            # کپی سطحی روی event loop؛ سریال‌سازی سنگین در ترد جدا انجام می‌شود
+            frozen = {
+                uid: {"history": list(data.get("history", [])), "stats": dict(data.get("stats", {}))}
+                for uid, data in users.items()
+            }
+            # تغییرات ذخیره‌نشده کپی را اول در ژورنال می‌نویسیم تا اسنپ‌شات دقیقاً تا snapshot_seq باشد
+            records = [(uid, self._make_record(uid, data)) for uid, data in frozen.items()]
+            records = [(uid, record) for uid, record in records if record is not None]
+            if records:
+                await self._append([record for _, record in records])
+                for uid, _ in records:
+                    self._mark_persisted(uid, frozen[uid])
+            snapshot_seq = self._seq
+            for uid in self._pending:
+                if uid not in frozen:
+                    frozen[uid] = self._read_user(uid)
+            copies = {uid: pos for uid, pos in self._index.items() if uid not in frozen}
+            reset = self._reset
+            generation = self._generation + 1
+            records_map = self._records_map
+
+        # فایل قبلی تا پایان کپی باز می‌ماند؛ فقط بعد از جایگزینی ایندکس بسته می‌شود
+        index = await asyncio.to_thread(self._write_snapshot, frozen, copies, records_map, snapshot_seq, reset, generation)
+
+        async with self._lock:
+            tmp_path, kept = await asyncio.to_thread(self._filter_journal, snapshot_seq)
+            # از اینجا به بعد بدون await؛ load_user همیشه وضعیت سازگاری می‌بیند
+            os.replace(tmp_path, self.journal_path)
+            old_records_path = self._records_path
+            self._open_records(index["records"])
+            self._index = {uid: tuple(pos) for uid, pos in index["users"].items()}
+            self._snapshot_seq = snapshot_seq
+            self._generation = generation
+            self._pending = {}
+            self._journal_size = 0
+            for record, length in kept:
+                self._register_pending(record, self._journal_size, length)
+                self._journal_size += length
+            if old_records_path and old_records_path != self._records_path:
+                os.remove(old_records_path)
+        print(f"Compacted user chats journal into a snapshot of {len(index['users'])} users.")
+
+    def _write_snapshot(self, frozen, copies, records_map, snapshot_seq, reset, generation):
+        base = os.path.splitext(self.index_path)[0]
+        records_path = f"{base}.{generation}.records.jsonl"
+        users_index = {}
+        now = time.time()
+        offset = 0
+        with open(records_path + ".tmp", "wb") as f:
+            for uid, data in frozen.items():
+                stats = data.get("stats", {"messages": 0, "generated_images": 0, "edited_images": 0})
+                line = (dumps({"history": data.get("history", []), "stats": stats, "ts": now}) + "\n").encode("utf-8")
+                f.write(line)
+                users_index[uid] = (offset, len(line))
+                offset += len(line)
+            for uid, (old_offset, length) in copies.items():
+                f.write(records_map[old_offset:old_offset + length])
+                users_index[uid] = (offset, length)
+                offset += length
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(records_path + ".tmp", records_path)
+
+        index = {
+            "seq": snapshot_seq,
+            "generation": generation,
+            "records": os.path.basename(records_path),
+            "reset": list(reset) if reset else None,
+            "users": users_index,
+        }
+        with open(self.index_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps(index))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.index_path + ".tmp", self.index_path)
+        return index
+
+    def _filter_journal(self, snapshot_seq):
+        kept = []
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "wb") as out:
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, "rb") as f:
+                    for line in f:
+                        record = loads(line.decode("utf-8"))
+                        if record["seq"] > snapshot_seq:
+                            out.write(line)
+                            kept.append((record, len(line)))
+        return tmp_path, kept
+
+
+class SaveScheduler:
+    """
+    Write-behind scheduler for user data.
+
+    Handlers only mark users as dirty; a single background loop flushes the
+    dirty set every `interval` seconds, or earlier once `batch_size` users are
+    waiting, so a burst of messages turns into a bounded number of writes.
+    """
+
+    def __init__(self, flush_fn, interval=2.0, batch_size=50):
+        self._flush_fn = flush_fn
+        self.interval = interval
+        self.batch_size = batch_size
+        self._dirty = set()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.flushes = 0
+        self.users_flushed = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def mark_dirty(self, user_id):
+        self._dirty.add(user_id)
+        if len(self._dirty) >= self.batch_size:
+            self._wakeup.set()
+
+    @property
+    def queue_depth(self):
+        return len(self._dirty)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            user_ids, self._dirty = self._dirty, set()
+            started = time.perf_counter()
+            try:
+                await self._flush_fn(user_ids)
+            except Exception as e:
+                # در صورت خطا کاربران دوباره در صف می‌مانند تا در دور بعد ذخیره شوند
+                print(f"Error flushing {len(user_ids)} dirty users: {e}")
+                self._dirty |= user_ids
+                return
+            elapsed = time.perf_counter() - started
+            self.flushes += 1
+            self.users_flushed += len(user_ids)
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+
+    async def stop(self):
+        """Stops the background loop and writes everything that is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "flushes": self.flushes,
+            "users_flushed": self.users_flushed,
+            "last_flush_ms": round(self.last_flush_seconds * 1000, 2),
+            "max_flush_ms": round(self.max_flush_seconds * 1000, 2),
+            "avg_flush_ms": round(self.total_flush_seconds * 1000 / self.flushes, 2) if self.flushes else 0.0,
+        }
@@ -0,0 +1,373 @@
+import asyncio
+import inspect
+import time
+import traceback
+from contextlib import nullcontext
+
+from md2tgmd import escape
+
+from admission import Overloaded
+from tracing import span
+
+
+def split_long_message(text, max_length=4000):
+    """تقسیم متن به بخش‌هایی با حداکثر max_length کاراکتر"""
+    if len(text) <= max_length:
+        return [text]
+    parts = []
+    while len(text) > max_length:
+        split_index = text.rfind('\n', 0, max_length)
+        if split_index == -1 or split_index < max_length // 2:
+            split_index = max_length
+        parts.append(text[:split_index])
+        text = text[split_index:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+class MarkdownV2Renderer:
+    """
+    Incrementally escapes a streamed markdown answer for Telegram's MarkdownV2.
+
+    Re-escaping the whole accumulated answer on every update costs quadratic
+    time over a long stream. Instead the text is committed paragraph by
+    paragraph: once a blank line arrives outside a ``` code block, everything
+    before it is escaped once and kept. Only the open paragraph (or the open
+    code block, rendered as if it were closed) is escaped again on each
+    update. md2tgmd's rules never look past a blank line outside a code block,
+    so the result matches escaping the whole text at once (except that a code
+    block the model never closed is closed instead of shown as raw backticks).
+    """
+
+    def __init__(self):
+        self._committed = []
+        self._tail = ""
+        self.raw_length = 0
+
+    def feed(self, delta):
+        self._tail += delta
+        self.raw_length += len(delta)
+        self._commit()
+
+    def _commit(self):
+        # آخرین خط خالی که خارج از بلوک کد باشد
+        pos = self._tail.rfind("\n\n")
+        while pos > 0 and self._tail.count("```", 0, pos) % 2:
+            pos = self._tail.rfind("\n\n", 0, pos)
+        if pos > 0:
+            self._committed.append(escape(self._tail[:pos]))
+            # خطوط خالی همراه پاراگراف بعدی می‌مانند؛ قواعد لیست md2tgmd به آن‌ها نگاه می‌کنند
+            self._tail = self._tail[pos:]
+
+    def _escaped_tail(self):
+        if not self._tail:
+            return ""
+        if self._tail.count("```") % 2:
+            # بلوک کد هنوز بسته نشده؛ موقتاً بسته می‌شود تا قالب‌بندی پیام نشکند
+            return escape(self._tail + "\n```")
+        return escape(self._tail)
+
+    def render(self, suffix=""):
+        """The escaped answer so far; only the open paragraph is escaped again."""
+        return "".join(self._committed) + self._escaped_tail() + suffix
+
+    def finish(self):
+        """The escaped complete answer."""
+        if self._tail:
+            self._committed.append(self._escaped_tail())
+            self._tail = ""
+        return "".join(self._committed)
+
+
+class LatestValue:
+    """Single-slot channel: publishing overwrites the value and the reader only ever sees the newest one."""
+
+    def __init__(self):
+        self._value = None
+        self._version = 0
+        self._seen = 0
+        self._changed = asyncio.Event()
+        self.closed = False
+
+    def publish(self, value):
+        self._value = value
+        self._version += 1
+        self._changed.set()
+
+    def close(self):
+        self.closed = True
+        self._changed.set()
+
+    async def next(self):
+        """Waits for a value newer than the last one read. Returns None once closed with nothing new."""
+        while self._version == self._seen:
+            if self.closed:
+                return None
+            self._changed.clear()
+            await self._changed.wait()
+        self._seen = self._version
+        return self._value
+
+    async def wait_closed(self, timeout):
+        """Sleeps for `timeout` seconds, returning early if the channel is closed."""
+        deadline = time.monotonic() + timeout
+        while not self.closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+
+class StreamPipeline:
+    """
+    Drains a model stream at full speed while a separate task renders frames of it.
+
+    The producer only appends each chunk's text to a buffer and publishes the
+    buffer's new length on a LatestValue channel, so a slow Telegram round trip
+    never holds the model connection open. The renderer task escapes whatever
+    arrived since its last frame, sends it with `send_frame(text, fallback_text)`
+    and waits `frame_interval()` before the next one; chunks that arrive in the
+    meantime are coalesced into a single frame. `drain_seconds` and the frame
+    round trips are measured separately.
+    """
+
+    def __init__(self, send_frame, frame_interval, cursor="✍️", renderer=None):
+        self.send_frame = send_frame
+        self.frame_interval = frame_interval
+        self.cursor = cursor
+        self.renderer = renderer or MarkdownV2Renderer()
+        self.channel = LatestValue()
+        self.text = ""
+        self._deltas = []
+        self._rendered = 0
+        self.drain_seconds = 0.0
+        self.frames = 0
+        self.frame_seconds = 0.0
+        self.frame_errors = 0
+
+    async def run(self, chunks):
+        """Consumes the stream and returns the full answer once it ends and the last frame is out."""
+        render_task = asyncio.create_task(self._render_loop())
+        started = time.monotonic()
+        try:
+            async for chunk in chunks:
+                text = getattr(chunk, "text", None)
+                if text:
+                    self._deltas.append(text)
+                    self.channel.publish(len(self._deltas))
+        except BaseException:
+            render_task.cancel()
+            raise
+        finally:
+            self.drain_seconds = time.monotonic() - started
+            self.channel.close()
+        await render_task
+        self._take_new_text()
+        return self.text
+
+    def _take_new_text(self):
+        new = self._deltas[self._rendered:]
+        self._rendered += len(new)
+        for delta in new:
+            self.renderer.feed(delta)
+        self.text += "".join(new)
+
+    async def _render_loop(self):
+        while await self.channel.next() is not None:
+            if self.channel.closed:
+                break  # پیام نهایی جای این فریم را می‌گیرد
+            self._take_new_text()
+            if not self.text.strip():
+                continue
+            started = time.monotonic()
+            try:
+                await self.send_frame(self.renderer.render(self.cursor), self.text + self.cursor)
+            except Exception as e:
+                # فریم میانی از دست رفته مهم نیست؛ پیام نهایی جدا ارسال می‌شود
+                self.frame_errors += 1
+                print(f"Error sending a streamed frame: {e}")
+            finished = time.monotonic()
+            self.frames += 1
+            self.frame_seconds += finished - started
+            await self.channel.wait_closed(self.frame_interval() - (finished - started))
+
+
+class StreamStats:
+    """Running totals of StreamPipeline timings, to tell model drain time from Telegram round trips."""
+
+    def __init__(self):
+        self.streams = 0
+        self.drain_seconds = 0.0
+        self.frames = 0
+        self.frame_seconds = 0.0
+        self.frame_errors = 0
+
+    def record(self, pipeline):
+        self.streams += 1
+        self.drain_seconds += pipeline.drain_seconds
+        self.frames += pipeline.frames
+        self.frame_seconds += pipeline.frame_seconds
+        self.frame_errors += pipeline.frame_errors
+
+    def stats(self):
+        return {
+            "streams": self.streams,
+            "avg_drain_ms": round(self.drain_seconds / self.streams * 1000, 1) if self.streams else 0.0,
+            "frames": self.frames,
+            "avg_frames_per_stream": round(self.frames / self.streams, 2) if self.streams else 0.0,
+            "avg_frame_round_trip_ms": round(self.frame_seconds / self.frames * 1000, 1) if self.frames else 0.0,
+            "frame_errors": self.frame_errors,
+        }
+
+
+class StreamEngine:
+    """
+    The single path every streamed answer (text, image and file) goes through.
+
+    A call is specialised with stage hooks:
+      build()                 -> the contents to send; sync or async, runs before anything is sent
+      invoke(lease, contents) -> awaitable of the model's chunk stream on the leased client
+      renderer()              -> a fresh renderer for the streamed text (MarkdownV2Renderer)
+      deliver(...)            -> sends the final answer (deliver() below by default)
+      account(full_response)  -> updates history and stats once the answer is delivered
+    Admission control, key failover, frame pacing, the MarkdownV2 fallback, stream
+    metrics and error reporting live here, so they apply to every modality.
+    """
+
+    def __init__(self, client_pool, edit_scheduler, stats=None, status_text="", empty_text="", error_text="",
+                 admission=None, position_text="{}", overloaded_text=""):
+        self.client_pool = client_pool
+        self.edit_scheduler = edit_scheduler
+        self.stats = stats
+        self.status_text = status_text
+        self.empty_text = empty_text
+        self.error_text = error_text
+        self.admission = admission
+        self.position_text = position_text
+        self.overloaded_text = overloaded_text
+
+    def admit(self, bot, workload, status_message=None, status_text=None):
+        """
+        A slot of `workload` from the admission controller. While the request is
+        queued, its position is shown under `status_text` in the status message.
+        """
+        if self.admission is None:
+            return nullcontext()
+        on_position = None
+        if status_message is not None:
+            on_position = lambda position: self.edit_scheduler.submit(
+                bot, status_message.chat.id, status_message.message_id,
+                f"{status_text or self.status_text}\n{self.position_text.format(position)}",
+            )
+        return self.admission.slot(workload, on_position)
+
+    async def run(self, bot, message, model, invoke, build=None, account=None, key=None,
+                  status_message=None, status_text=None, renderer=MarkdownV2Renderer, deliver=None,
+                  workload="text"):
+        """
+        Streams one answer into a status message. `status_message` is reused (and changed
+        to `status_text` if given) instead of replying with a new one. The model call waits
+        for a slot of `workload`. Returns the full answer, or None if it failed or was shed
+        and the user was told.
+        """
+        sent_message = status_message
+        lease = None
+        try:
+            with span("build"):
+                contents = build() if build else None
+                if inspect.isawaitable(contents):
+                    contents = await contents
+
+            if sent_message is None:
+                sent_message = await bot.reply_to(message, self.status_text)
+            elif status_text:
+                await bot.edit_message_text(status_text, chat_id=sent_message.chat.id, message_id=sent_message.message_id)
+
+            async with self.admit(bot, workload, sent_message, status_text):
+                lease, chunks = await self.client_pool.stream(model, lambda lease: invoke(lease, contents), key=key)
+                chat_id, message_id = sent_message.chat.id, sent_message.message_id
+                pipeline = StreamPipeline(
+                    lambda text, fallback: self.edit_scheduler.edit(
+                        bot, chat_id, message_id, text, parse_mode="MarkdownV2", fallback_text=fallback
+                    ),
+                    lambda: self.edit_scheduler.frame_interval(chat_id),
+                    renderer=renderer(),
+                )
+                with span("stream"):
+                    full_response = await pipeline.run(chunks)
+                lease.release()
+            if self.stats is not None:
+                self.stats.record(pipeline)
+
+            final_text = pipeline.renderer.finish() if full_response else escape(self.empty_text)
+            with span("deliver"):
+                await (deliver or self.deliver)(bot, message, sent_message, final_text)
+            if account:
+                account(full_response)
+            return full_response
+        except Overloaded:
+            await self.report_overloaded(bot, message, sent_message)
+            return None
+        except Exception as e:
+            traceback.print_exc()
+            if lease:
+                lease.release(e)
+            await self.report_error(bot, message, sent_message, e)
+            return None
+        except BaseException:
+            if lease:
+                lease.abandon()
+            raise
+
+    async def deliver(self, bot, message, sent_message, final_text):
+        """Puts the first 4000 characters into the status message and sends the rest as new messages."""
+        for i, part in enumerate(split_long_message(final_text, 4000)):
+            if i == 0:
+                # اگر MarkdownV2 رد شود همان متن بدون قالب‌بندی ارسال می‌شود
+                await self.edit_scheduler.edit(
+                    bot, sent_message.chat.id, sent_message.message_id, part,
+                    parse_mode="MarkdownV2", fallback_text=part, final=True
+                )
+                continue
+            try:
+                await self.edit_scheduler.send_message(bot, message.chat.id, part, parse_mode="MarkdownV2")
+            except Exception:
+                await self.edit_scheduler.send_message(bot, message.chat.id, part)
+
+    async def reply(self, bot, message, text):
+        """Sends an answer that is already known (e.g. a cached one) as a reply, formatted like a streamed one."""
+        renderer = MarkdownV2Renderer()
+        renderer.feed(text)
+        for i, part in enumerate(split_long_message(renderer.finish(), 4000)):
+            kwargs = {'reply_to_message_id': message.message_id} if i == 0 else {}
+            try:
+                await self.edit_scheduler.send_message(bot, message.chat.id, part, parse_mode="MarkdownV2", **kwargs)
+            except Exception:
+                await self.edit_scheduler.send_message(bot, message.chat.id, part, **kwargs)
+
+    async def report_overloaded(self, bot, message, sent_message):
+        try:
+            if sent_message:
+                await self.edit_scheduler.edit(bot, sent_message.chat.id, sent_message.message_id, self.overloaded_text)
+            else:
+                await bot.reply_to(message, self.overloaded_text)
+        except Exception as e:
+            print(f"Error telling a user that the bot is overloaded: {e}")
+
+    async def report_error(self, bot, message, sent_message, error):
+        err = f"{self.error_text}\nجزئیات خطا: {str(error)}"
+        try:
+            if sent_message:
+                await bot.edit_message_text(err, chat_id=sent_message.chat.id, message_id=sent_message.message_id)
+                return
+        except Exception:
+            pass
+        try:
+            await bot.reply_to(message, err)
+        except Exception as e:
+            print(f"Error reporting a failed stream to the user: {e}")
@@ -0,0 +1,68 @@
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import gemini
+from file_refs import FileRefs
+from media_cache import MediaCache
+
+
+class _Chats:
+    def __init__(self):
+        self.created = []
+
+    def create(self, model, history=None, config=None):
+        self.created.append(history)
+        return SimpleNamespace(get_history=lambda: list(history))
+
+
+class _Files:
+    def __init__(self):
+        self.uploads = 0
+
+    async def upload(self, file, config=None):
+        self.uploads += 1
+        return SimpleNamespace(name="files/voice", uri="https://files/voice", state="ACTIVE", expiration_time=None)
+
+
+class ChatSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_rebuilt_session_gets_uploaded_files_instead_of_refs(self):
+        chats, files = _Chats(), _Files()
+        lease = SimpleNamespace(key="k1", client=SimpleNamespace(aio=SimpleNamespace(chats=chats, files=files)))
+        media_cache = MediaCache(self.directory.name)
+        history = [
+            {'role': 'user', 'parts': [{'text': 'p'}]},
+            {'role': 'model', 'parts': [{'text': 'ok'}]},
+            {'role': 'user', 'parts': [{'text': 'voice'}, FileRefs.part("v1", "audio/ogg")]},
+            {'role': 'model', 'parts': [{'text': 'transcript'}]},
+        ]
+
+        async def run():
+            await media_cache._write_disk("v1", b"ogg")
+            # جلسه‌ای در حافظه نیست، مثل بعد از راه‌اندازی مجدد یا بیکاری
+            gemini.user_chats["test-user"] = {"history": history, "stats": {"messages": 2}}
+            try:
+                await gemini._get_chat_session("test-user", None, gemini.model_1, lease)
+            finally:
+                del gemini.user_chats["test-user"]
+
+        with mock.patch.object(gemini, "file_refs", FileRefs(media_cache)), \
+                mock.patch.object(gemini.prompt_cache, "enabled", False):
+            asyncio.run(run())
+
+        rebuilt = chats.created[-1]
+        self.assertEqual(files.uploads, 1)
+        self.assertEqual(rebuilt[2]['parts'][1], {'file_data': {'file_uri': "https://files/voice", 'mime_type': "audio/ogg"}})
+        self.assertFalse(any('file_ref' in part for turn in rebuilt for part in turn['parts']))
+        # تاریخچه ذخیره‌شده همچنان ارجاع فایل را نگه می‌دارد
+        self.assertEqual(history[2]['parts'][1], FileRefs.part("v1", "audio/ogg"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from context import ContextManager
+from storage import ChatStore
+
+
+def _entry(role, text):
+    return {'role': role, 'parts': [{'text': text}]}
+
+
+class ChatStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def _store(self):
+        return ChatStore(os.path.join(self.directory.name, "index.json"), os.path.join(self.directory.name, "journal.jsonl"))
+
+    def _reload(self, uid):
+        store = self._store()
+        asyncio.run(store.load())
+        return store.load_user(uid)
+
+    def test_folded_history_survives_reload(self):
+        async def run():
+            store = self._store()
+            await store.load()
+            history = [_entry("user", "p"), _entry("model", "ok"),
+                       _entry("user", "a"), _entry("model", "b"), _entry("user", "c"), _entry("model", "d")]
+            users = {"1": {"history": history, "stats": {"messages": 2}}}
+            await store.save(users)
+
+            # خلاصه‌سازی a و b را حذف و جفت خلاصه را بعد از پیش‌درآمد اضافه می‌کند
+            context = ContextManager(None)
+            users["1"]["history"] = context.with_summary(history, "summary", history[2:4])
+            store.rewrite("1")
+            await store.save(users)
+            return users["1"]["history"]
+
+        expected = asyncio.run(run())
+        self.assertEqual(self._reload("1")["history"], expected)
+
+    def test_appends_and_front_trims_survive_reload(self):
+        async def run():
+            store = self._store()
+            await store.load()
+            users = {"1": {"history": [_entry("user", str(i)) for i in range(4)], "stats": {}}}
+            await store.save(users)
+            users["1"]["history"] = users["1"]["history"][2:] + [_entry("model", "new")]
+            await store.save(users)
+            return users["1"]["history"]
+
+        expected = asyncio.run(run())
+        self.assertEqual(self._reload("1")["history"], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+import aiofiles
+
+
+# trace درخواست فعلی؛ تسک‌هایی که در طول درخواست ساخته می‌شوند هم آن را می‌بینند
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """One request: its ID and the timings of the stages it went through."""
+
+    __slots__ = ("id", "name", "user_id", "started_at", "started", "seconds", "error", "spans", "_token")
+
+    def __init__(self, name, user_id=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.user_id = user_id
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.seconds = None
+        self.error = None
+        self.spans = []
+        self._token = None
+
+    def add(self, name, started, ended, error=None):
+        if self.seconds is not None:
+            return  # کار پس‌زمینه‌ای که بعد از پایان درخواست تمام شده
+        span = {"name": name, "start_ms": round((started - self.started) * 1000, 1), "ms": round((ended - started) * 1000, 1)}
+        if error:
+            span["error"] = error
+        self.spans.append(span)
+
+    def to_dict(self):
+        data = {
+            "id": self.id,
+            "name": self.name,
+            "user": self.user_id,
+            "time": round(self.started_at, 3),
+            "ms": round(self.seconds * 1000, 1) if self.seconds is not None else None,
+            "spans": sorted(self.spans, key=lambda span: span["start_ms"]),
+        }
+        if self.error:
+            data["error"] = self.error
+        return data
+
+
+def current_id():
+    trace = current_trace.get()
+    return trace.id if trace is not None else None
+
+
+def record(name, started):
+    """Adds a stage that began at `started` (time.monotonic()) and ends now to the current request."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, started, time.monotonic())
+
+
+@contextmanager
+def span(name):
+    """Times a stage of the current request; does nothing outside a traced request."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.monotonic()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.add(name, started, time.monotonic(), error)
+
+
+class Tracer:
+    """
+    Starts and finishes request traces.
+
+    start() creates a trace with a new request ID and makes it current, so
+    every span() on the way (membership check, downloads, queues, model calls,
+    delivery) is recorded in it, including in tasks started for the request.
+    Finished traces are appended to a JSON-lines log in the background, one
+    line per request, and the `keep_slowest` slowest are kept in memory.
+    """
+
+    def __init__(self, log_path, keep_slowest=20, max_log_bytes=50 * 1024 * 1024, flush_interval=1.0):
+        self.log_path = log_path
+        self.keep_slowest = keep_slowest
+        self.max_log_bytes = max_log_bytes
+        self.flush_interval = flush_interval
+        self._slowest = []  # min-heap of (seconds, seq, trace dict)
+        self._seq = itertools.count()
+        self._lines = []
+        self._flush_task = None
+        self.traces = 0
+        self.errors = 0
+        self.write_errors = 0
+
+    def start(self, name, user_id=None):
+        trace = Trace(name, user_id)
+        trace._token = current_trace.set(trace)
+        return trace
+
+    def finish(self, trace, error=None):
+        trace.seconds = time.monotonic() - trace.started
+        if error is not None:
+            trace.error = type(error).__name__
+            self.errors += 1
+        try:
+            current_trace.reset(trace._token)
+        except ValueError:
+            pass  # finish() از context دیگری صدا زده شده
+        self.traces += 1
+        data = trace.to_dict()
+        entry = (trace.seconds, next(self._seq), data)
+        if len(self._slowest) < self.keep_slowest:
+            heapq.heappush(self._slowest, entry)
+        elif entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+        self._lines.append(json.dumps(data, ensure_ascii=False))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+
+    def slowest(self):
+        """The slowest finished traces, slowest first."""
+        return [data for _, _, data in sorted(self._slowest, reverse=True)]
+
+    async def _flush(self):
+        try:
+            await asyncio.sleep(self.flush_interval)
+            lines, self._lines = self._lines, []
+            if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.max_log_bytes:
+                os.replace(self.log_path, self.log_path + ".1")
+            async with aiofiles.open(self.log_path, "a", encoding="utf-8") as f:
+                await f.write("\n".join(lines) + "\n")
+        except Exception as e:
+            self.write_errors += 1
+            print(f"Error writing traces to {self.log_path}: {e}")
+        finally:
+            self._flush_task = None
+            if self._lines:
+                self._flush_task = asyncio.create_task(self._flush())
+
+    def stats(self):
+        return {
+            "traces": self.traces,
+            "errors": self.errors,
+            "write_errors": self.write_errors,
+            "pending_lines": len(self._lines),
+            "slowest_ms": round(max(self._slowest)[0] * 1000, 1) if self._slowest else 0.0,
+        }
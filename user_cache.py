@@ -0,0 +1,138 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class UserCache(OrderedDict):
+    """
+    Bounded LRU cache of per-user state (history, stats and the live chat session) in front of ChatStore.
+
+    Reading a user through `cache[uid]` or get_or_load() marks them as recently
+    used and loads them from the store if they are not in memory. Once more than
+    `max_users` users are cached, the least recently used ones that have been
+    idle for at least `min_idle_seconds` are written back to the store and
+    dropped. A periodic sweep also closes chat sessions idle for longer than
+    `session_idle_seconds` while keeping the user's history and stats. Every
+    turn of a session is also in the stored history, so closing or evicting a
+    session loses nothing; it is rebuilt from that history when needed again.
+    """
+
+    def __init__(self, store, max_users=2000, session_idle_seconds=1800, min_idle_seconds=300, sweep_interval=60):
+        super().__init__()
+        self.store = store
+        self.max_users = max_users
+        self.session_idle_seconds = session_idle_seconds
+        self.min_idle_seconds = min_idle_seconds
+        self.sweep_interval = sweep_interval
+        self._last_access = {}
+        self._eviction_task = None
+        self._sweep_task = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.session_evictions = 0
+
+    def _touch(self, uid):
+        self.move_to_end(uid)
+        self._last_access[uid] = time.monotonic()
+
+    def __getitem__(self, uid):
+        data = self.get_or_load(uid)
+        if data is None:
+            raise KeyError(uid)
+        return data
+
+    def __setitem__(self, uid, data):
+        super().__setitem__(uid, data)
+        self._touch(uid)
+        if len(self) > self.max_users:
+            self._schedule_eviction()
+
+    def __delitem__(self, uid):
+        super().__delitem__(uid)
+        self._last_access.pop(uid, None)
+
+    def clear(self):
+        super().clear()
+        self._last_access.clear()
+
+    def get_or_load(self, uid):
+        """Returns the cached user, loading them from the store on a miss. None for unknown users."""
+        if uid in self:
+            self.hits += 1
+            self._touch(uid)
+            return super().__getitem__(uid)
+        self.misses += 1
+        data = self.store.load_user(uid) if self.store.has_user(uid) else None
+        if data is not None:
+            self[uid] = data
+        return data
+
+    # ---------- eviction ----------
+
+    def _schedule_eviction(self):
+        if self._eviction_task is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._eviction_task = loop.create_task(self._evict())
+
+    async def _evict(self):
+        try:
+            now = time.monotonic()
+            excess = len(self) - self.max_users
+            victims = []
+            for uid in self:  # قدیمی‌ترین کاربران اول
+                if len(victims) >= excess:
+                    break
+                if now - self._last_access.get(uid, 0) >= self.min_idle_seconds:
+                    victims.append(uid)
+            if not victims:
+                return
+            stamps = {uid: self._last_access.get(uid) for uid in victims}
+            await self.store.save(self, victims)
+            for uid in victims:
+                # کاربری که هنگام نوشتن دوباره فعال شده در حافظه می‌ماند
+                if uid in self and self._last_access.get(uid) == stamps[uid]:
+                    del self[uid]
+                    self.store.forget(uid)
+                    self.evictions += 1
+        except Exception as e:
+            print(f"Error evicting users from the cache: {e}")
+        finally:
+            self._eviction_task = None
+
+    def start(self):
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+        return self._sweep_task
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    def sweep(self):
+        """Closes idle chat sessions and evicts users beyond the budget."""
+        now = time.monotonic()
+        for uid, data in self.items():
+            if data.get("chat_session") is not None and now - self._last_access.get(uid, 0) >= self.session_idle_seconds:
+                data["chat_session"] = None
+                data["chat_model"] = None
+                self.session_evictions += 1
+        if len(self) > self.max_users:
+            self._schedule_eviction()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self),
+            "sessions": sum(1 for data in self.values() if data.get("chat_session") is not None),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "session_evictions": self.session_evictions,
+        }
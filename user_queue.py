@@ -0,0 +1,140 @@
+import asyncio
+import contextvars
+import time
+import traceback
+from collections import deque
+
+from tracing import record
+
+
+class _Request:
+    __slots__ = ("run", "texts", "merge_key", "ready_at", "future", "context", "enqueued_at")
+
+    def __init__(self, run, texts, merge_key, ready_at, future, context, enqueued_at):
+        self.run = run
+        self.texts = texts
+        self.merge_key = merge_key
+        self.ready_at = ready_at
+        self.future = future
+        self.context = context
+        self.enqueued_at = enqueued_at
+
+
+class UserQueue:
+    """
+    Runs each user's model requests one at a time, in the order they arrived.
+
+    Every user with pending requests has one worker task, so two requests of a
+    user never use their chat session or history at the same time. A request
+    of an idle user starts right away. Text messages with the same merge key
+    (chat and model) that arrive while an earlier request of the user is still
+    running are merged into one turn: once it is its turn, the merged request
+    still waits until `debounce_seconds` after its latest message, and up to
+    `max_merged` messages are joined. The merged turn is answered as a reply
+    to the latest of them. A request runs in the context (contextvars)
+    of the handler that submitted it, not in the worker's.
+    """
+
+    def __init__(self, debounce_seconds=0.0, max_merged=5):
+        self.debounce_seconds = debounce_seconds
+        self.max_merged = max_merged
+        self._pending = {}  # user -> deque of requests that have not started
+        self._workers = {}  # user -> worker task
+        self.requests = 0
+        self.merged = 0
+        self.max_depth = 0
+
+    def depth(self, user_id):
+        """Requests of the user that are waiting or running."""
+        return len(self._pending.get(user_id, ())) + (1 if user_id in self._workers else 0)
+
+    async def submit(self, user_id, run, text=None, merge_key=None):
+        """
+        Queues a request and waits until it has been handled. Without `text`,
+        run() is awaited; with it, run(text) is awaited with the merged text of
+        this and any following messages, or this message is merged into the
+        user's previous queued request and that one's run is used instead.
+        """
+        self.requests += 1
+        now = time.monotonic()
+        pending = self._pending.setdefault(user_id, deque())
+        last = pending[-1] if pending else None
+        if (text is not None and last is not None and last.texts is not None
+                and last.merge_key == merge_key and len(last.texts) < self.max_merged):
+            # پیام‌های پشت‌سرهم کاربر یک نوبت می‌شوند و به آخرین پیام پاسخ داده می‌شود
+            last.texts.append(text)
+            last.run = run
+            last.ready_at = now + self.debounce_seconds
+            last.context = contextvars.copy_context()
+            last.enqueued_at = now
+            self.merged += 1
+            request = last
+        else:
+            request = _Request(
+                run,
+                [text] if text is not None else None,
+                merge_key,
+                # کاربری که درخواست در حال اجرا ندارد منتظر نمی‌ماند
+                now + self.debounce_seconds if text is not None and user_id in self._workers else now,
+                asyncio.get_running_loop().create_future(),
+                contextvars.copy_context(),
+                now,
+            )
+            pending.append(request)
+        self.max_depth = max(self.max_depth, self.depth(user_id))
+        if user_id not in self._workers:
+            self._workers[user_id] = asyncio.create_task(self._work(user_id, pending))
+        await asyncio.shield(request.future)
+
+    async def _work(self, user_id, pending):
+        current = None
+        try:
+            while pending:
+                request = pending[0]
+                delay = request.ready_at - time.monotonic()
+                if delay > 0:
+                    # ممکن است در این فاصله پیام دیگری اضافه شود و زمان شروع عقب برود
+                    await asyncio.sleep(delay)
+                    continue
+                current = pending.popleft()
+                # زمان انتظار در صف در trace همان درخواست ثبت می‌شود
+                current.context.run(record, "user_queue", current.enqueued_at)
+                coro = current.run() if current.texts is None else current.run("\n".join(current.texts))
+                # تسک در context همان هندلری اجرا می‌شود که درخواست را فرستاده
+                task = current.context.run(asyncio.ensure_future, coro)
+                try:
+                    await asyncio.wait({task})
+                except BaseException:
+                    # خود worker لغو شده، مثلا هنگام خاموش شدن
+                    task.cancel()
+                    raise
+                if task.cancelled():
+                    current.future.cancel()
+                elif task.exception() is not None:
+                    error = task.exception()
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                    current.future.set_exception(error)
+                else:
+                    current.future.set_result(None)
+                current = None
+        finally:
+            del self._workers[user_id]
+            # اگر worker متوقف شده باشد هیچ‌کس نباید منتظر درخواستی بماند که دیگر اجرا نمی‌شود
+            for request in ([current] if current is not None else []) + list(pending):
+                if not request.future.done():
+                    request.future.cancel()
+            pending.clear()
+            self._pending.pop(user_id, None)
+
+    def stats(self):
+        # فقط آمار کلی؛ شناسه کاربران در /metrics منتشر نمی‌شود
+        depths = [self.depth(user_id) for user_id in set(self._pending) | set(self._workers)]
+        return {
+            "active_users": len(self._workers),
+            "waiting_users": sum(1 for pending in self._pending.values() if pending),
+            "queued_requests": sum(len(pending) for pending in self._pending.values()),
+            "requests": self.requests,
+            "merged": self.merged,
+            "depth": max(depths, default=0),
+            "max_depth": self.max_depth,
+        }
@@ -0,0 +1,126 @@
+import asyncio
+import hmac
+import json
+import traceback
+
+from aiohttp import web
+from telebot import types
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def health(request):
+    return web.Response(text="bot is alive ✅")
+
+
+def create_app(server=None, registry=None):
+    """
+    The bot's HTTP app: the health check on "/", the metrics of `registry` on "/metrics"
+    and, given a WebhookServer, Telegram's webhook route.
+    """
+    app = web.Application()
+    app.router.add_get("/", health)
+    if registry is not None:
+        async def metrics(request):
+            return web.Response(
+                body=registry.render().encode("utf-8"),
+                headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+            )
+        app.router.add_get("/metrics", metrics)
+    if server is not None:
+        app.router.add_post(server.path, server.handle)
+        app.on_startup.append(server.start)
+        app.on_cleanup.append(server.stop)
+    return app
+
+
+class WebhookServer:
+    """
+    Receives Telegram updates by webhook, on the same event loop as the bot.
+
+    A request is checked against the secret token given to setWebhook, queued
+    and acknowledged right away, so Telegram never waits for a handler. A
+    dispatcher starts a task for each queued update, so a slow chat (a long
+    model stream, a user queue wait) never holds up unrelated updates. At most
+    `max_handlers` run at once, which should match what the admission
+    controller can run or queue; the model work inside them is limited there.
+    When the queue is full the update is refused with 503 and Telegram
+    delivers it again later.
+    """
+
+    def __init__(self, bot, secret_token, path="/webhook", max_handlers=64, queue_size=1000):
+        self.bot = bot
+        self.secret_token = secret_token
+        self.path = path
+        self.max_handlers = max_handlers
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._slots = asyncio.Semaphore(max_handlers)
+        self._dispatcher = None
+        self._handlers = set()
+        self.received = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+
+    async def handle(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret_token):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # تلگرام این آپدیت را بعدا دوباره می‌فرستد
+            self.dropped += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def _dispatch(self):
+        while True:
+            await self._slots.acquire()
+            data = await self._queue.get()
+            self._queue.task_done()
+            task = asyncio.create_task(self._process(data))
+            self._handlers.add(task)
+            task.add_done_callback(self._handler_done)
+
+    def _handler_done(self, task):
+        self._handlers.discard(task)
+        self._slots.release()
+
+    async def _process(self, data):
+        try:
+            await self.bot.process_new_updates([types.Update.de_json(data)])
+            self.processed += 1
+        except Exception:
+            self.errors += 1
+            traceback.print_exc()
+
+    async def start(self, app=None):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self, app=None):
+        tasks = [task for task in [self._dispatcher, *self._handlers] if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "handlers": len(self._handlers),
+            "max_handlers": self.max_handlers,
+            "received": self.received,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "errors": self.errors,
+        }